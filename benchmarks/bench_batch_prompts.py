@@ -0,0 +1,69 @@
+"""
+Compares single-email classification with K emails per Ollama request.
+For every K it reports emails/sec and how often the batched answer agrees with single-email mode.
+Needs a running Ollama (or the fake one, see OLLAMA_HOST) with SORTER_MODEL pulled.
+Usage: python benchmarks/bench_batch_prompts.py [num_emails] [K,K,...]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from email_sorter import analyze_email, analyze_emails
+
+SAMPLES = [
+    ("Deals <news@shop.example>", "🔥 48 hours only: 40% off everything", "Don't miss our biggest sale of the year. "
+     "Shop new arrivals, bestsellers and more. Unsubscribe at any time."),
+    ("Weekly Digest <digest@news.example>", "Your weekly roundup", "Here are the top stories we picked for you "
+     "this week, plus a sponsored message from our partners."),
+    ("Bank <alerts@bank.example>", "Your March statement is ready", "Your account statement for March is now "
+     "available. Log in to online banking to view it."),
+    ("Airline <booking@air.example>", "Booking confirmation ABC123", "Thank you for booking with us. Your flight "
+     "departs on 12 May at 08:45. Your e-ticket is attached."),
+    ("Mom <mom@family.example>", "Sunday dinner", "Hi sweetie, are you coming over on Sunday? Let me know so I "
+     "can plan the food. Love you."),
+    ("Pizza Place <orders@pizza.example>", "Receipt for your order", "Thanks for your order! 1x Large Margherita, "
+     "total $18.50. Paid with Visa ending 4242."),
+    ("Community <hello@forum.example>", "You have 3 new notifications", "Someone replied to your post and 2 "
+     "people liked your comment. Log in to see more."),
+]
+
+
+def main():
+    num_emails = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    ks = [int(k) for k in sys.argv[2].split(",")] if len(sys.argv) > 2 else [1, 4, 8, 16]
+
+    random.seed(0)
+    emails = []
+    for i in range(num_emails):
+        sender, subject, body = random.choice(SAMPLES)
+        emails.append((f"{subject} #{i}", sender, body))
+
+    start = time.perf_counter()
+    baseline = [analyze_email(*email) or 'ec_not_sure' for email in emails]
+    elapsed = time.perf_counter() - start
+    print(f"K=1:  {num_emails / elapsed:.2f} emails/sec")
+
+    for k in ks:
+        if k == 1:
+            continue
+        start = time.perf_counter()
+        decisions = []
+        retries = 0
+        for i in range(0, num_emails, k):
+            batch = emails[i:i + k]
+            for email, decision in zip(batch, analyze_emails(batch)):
+                if decision is None:
+                    retries += 1
+                    decision = analyze_email(*email)
+                decisions.append(decision or 'ec_not_sure')
+        elapsed = time.perf_counter() - start
+        agreement = sum(a == b for a, b in zip(baseline, decisions)) / num_emails
+        print(f"K={k}: {num_emails / elapsed:.2f} emails/sec, {agreement:.0%} agreement with K=1, "
+              f"{retries} retried on their own")
+
+
+if __name__ == '__main__':
+    main()
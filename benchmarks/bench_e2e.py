@@ -0,0 +1,446 @@
+"""
+Offline end-to-end benchmark of the bot and the email sorter. Telegram, Ollama and Gmail are
+replaced by local fakes, so it runs without any accounts or models. Drives the /remind, chat,
+/read and /ask handlers through telebot's update processing plus full email sorter runs, and reports
+p50/p99 latency, time until a chat reply first shows up, throughput and peak RSS as JSON on stdout
+(everything else goes to stderr).
+Usage: python benchmarks/bench_e2e.py [--iterations 200] [--out report.json] [--compare old_report.json]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from classification_cache import CACHE_FILE
+from fake_gmail import FakeGmailService
+from fake_ollama import FakeOllama
+from fake_qbittorrent import FakeQbittorrent
+from fake_telegram import FakeTelegram, UpdateFeed
+
+USER_ID = 4242
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def summarize(latencies, elapsed, items=None):
+    items = len(latencies) if items is None else items
+    return {
+        'count': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+        'throughput_per_sec': round(items / elapsed, 2),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+
+def measure(func, iterations, items_per_call=1):
+    latencies = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        started = time.perf_counter()
+        func(i)
+        latencies.append(time.perf_counter() - started)
+    return summarize(latencies, time.perf_counter() - start, iterations * items_per_call)
+
+
+def prompt_reuse(fake_ollama, run):
+    # Share of the prompt tokens sent while run() is going that Ollama could take from its cache,
+    # and how many it had to evaluate per chat request (summaries included)
+    sent, evaluated = fake_ollama.prompt_tokens, fake_ollama.evaluated_tokens
+    chats = fake_ollama.requests.get('/api/chat', 0)
+    result = run()
+    sent, evaluated = fake_ollama.prompt_tokens - sent, fake_ollama.evaluated_tokens - evaluated
+    chats = fake_ollama.requests.get('/api/chat', 0) - chats
+    result['prompt_reuse'] = round(1 - evaluated / sent, 3) if sent else None
+    result['evaluated_tokens_per_chat'] = round(evaluated / chats, 1) if chats else None
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(report, old_report):
+    print(f"Compared with {old_report.get('commit')}:", file=sys.stderr)
+    for name, result in report['results'].items():
+        old = old_report.get('results', {}).get(name)
+        if not old:
+            continue
+        changes = []
+        for key in ('p50_ms', 'p99_ms', 'throughput_per_sec'):
+            if old[key]:
+                changes.append(f"{key} {(result[key] - old[key]) / old[key]:+.1%}")
+        print(f"  {name}: " + ", ".join(changes), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--reminders', type=int, default=300, help="reminders stored before the chat benchmark")
+    parser.add_argument('--emails', type=int, default=500)
+    parser.add_argument('--sorter-runs', type=int, default=3)
+    parser.add_argument('--chats', type=int, default=4, help="chats sending a message at the same time")
+    parser.add_argument('--reads', type=int, default=5, help="how many times /read loads the file")
+    parser.add_argument('--docs', type=int, default=100, help="extra files in analysis/ for /reindex and /ask")
+    parser.add_argument('--file-kb', type=int, default=256, help="size of the file /read loads")
+    parser.add_argument('--token-latency', type=float, default=0.002)
+    parser.add_argument('--gmail-latency', type=float, default=0.05)
+    parser.add_argument('--load-latency', type=float, default=1.0, help="seconds Ollama takes to load a model")
+    parser.add_argument('--burst', type=int, default=20, help="reminders that are due at the same moment")
+    parser.add_argument('--ssh-handshake', type=float, default=0.3, help="seconds ssh takes to connect to the server")
+    parser.add_argument('--torrents', type=int, default=30, help="downloads watched by the torrent monitor")
+    parser.add_argument('--download-time', type=float, default=1.0, help="seconds every fake download takes")
+    parser.add_argument('--out')
+    parser.add_argument('--compare')
+    args = parser.parse_args()
+    # The benchmark changes into a temporary directory below
+    args.out = os.path.abspath(args.out) if args.out else None
+    args.compare = os.path.abspath(args.compare) if args.compare else None
+    # The bot, the sorter and the torrent monitor print their own logs. They go to stderr
+    # with the rest, so stdout only gets the JSON report and can be piped into jq.
+    report_out = sys.stdout
+    sys.stdout = sys.stderr
+
+    fake_ollama = FakeOllama(token_latency=args.token_latency, load_latency=args.load_latency).start()
+    fake_telegram = FakeTelegram().start()
+    os.environ.update({
+        'TELEGRAM_TOKEN': '123456:FAKE-TOKEN', 'ALLOWED_USER_ID': str(USER_ID), 'YOUR_NAME': 'Cooper',
+        'BOT_NAME': 'TARS', 'MODEL_NAME': 'gemma3:4b', 'OLLAMA_HOST': fake_ollama.url,
+        # Telegram's per-chat limit would make every case wait, they measure the bot's own latency.
+        # The reminder burst below uses the real limits.
+        'TELEGRAM_CHAT_RATE': '100000', 'TELEGRAM_CHAT_BURST': '100000', 'TELEGRAM_GLOBAL_RATE': '100000',
+    })
+
+    # The bot keeps its reminders, caches and analysis/ folder relative to the working directory
+    os.chdir(tempfile.mkdtemp(prefix='tars-bench-'))
+    # /torrent runs the fake ssh, which takes --ssh-handshake seconds to connect
+    os.makedirs('bin')
+    with open(os.path.join('bin', 'ssh'), 'w') as f:
+        f.write(f'#!/bin/sh\nexec {sys.executable} {os.path.join(BENCH_DIR, "fake_ssh.py")} "$@"\n')
+    os.chmod(os.path.join('bin', 'ssh'), 0o755)
+    os.environ.update({
+        'PATH': os.path.abspath('bin') + os.pathsep + os.environ['PATH'],
+        'SSH_TARGET': 'user@server', 'TORRENT_PATH': '/opt/torrent.py', 'SSH_CONTROL_PATH': os.path.abspath('ssh-control'),
+        'FAKE_SSH_HANDSHAKE': str(args.ssh_handshake), 'FAKE_SSH_LOG': os.path.abspath('ssh.log'),
+    })
+    os.makedirs('analysis')
+    with open(os.path.join('analysis', 'big.txt'), 'w') as f:
+        line = "The quarterly numbers went up in the north region and down in the south region.\n"
+        f.write(line * (args.file_kb * 1024 // len(line)))
+    for n in range(args.docs):
+        with open(os.path.join('analysis', f'note{n}.txt'), 'w') as f:
+            f.write(f"Meeting note {n} about project {n % 9}, budget and next steps.\n" * 40)
+
+    import telebot
+    import telebot.asyncio_helper
+    telebot.asyncio_helper.API_URL = fake_telegram.api_url
+    import main as tars
+    import email_sorter
+    from telegram_dispatcher import OutboundDispatcher
+    from webhook_server import WebhookServer, SECRET_HEADER
+    import aiohttp
+    # Every update is processed to the end on one event loop, so it is timed from arrival to the last API call
+    loop = asyncio.new_event_loop()
+    feed = UpdateFeed(USER_ID)
+
+    def update(feed, text):
+        return telebot.types.Update.de_json(json.dumps(feed.update(text)))
+
+    async def process(updates):
+        # Handlers only queue their messages, the update is done once they are sent
+        await tars.bot.process_new_updates(updates)
+        await tars.outbox.drain()
+
+    def drive(text):
+        loop.run_until_complete(process([update(feed, text)]))
+
+    # Like at startup, the chat model is loaded before the first message
+    loop.run_until_complete(tars.models.warm(tars.model))
+
+    results = {}
+    results['set_reminder'] = measure(lambda i: drive(f"/remind {i % 59 + 1}m water the plants {i}"),
+                                      args.reminders)
+    # Answered by the intent router from the reminder store
+    results['reminder_question'] = measure(lambda i: drive("What are my reminders for today?"), args.iterations)
+    # Answered by the LLM
+    results['handle_message'] = prompt_reuse(fake_ollama, lambda: measure(
+        lambda i: drive("What should I do first today?"), args.iterations))
+
+    # Time until the reply starts showing up in the chat, not just until it is complete
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        sent_before = len(fake_telegram.sent)
+        started = time.perf_counter()
+        drive("What should I do first today?")
+        latencies.append(fake_telegram.sent[sent_before][2] - started)
+    results['handle_message_first_visible'] = summarize(latencies, time.perf_counter() - start)
+
+    # Several chats at once, their replies go through the LLM queue
+    feeds = [UpdateFeed(USER_ID, chat_id=USER_ID + n) for n in range(args.chats)]
+
+    async def burst():
+        await asyncio.gather(*(process([update(f, "Any plans for today?")]) for f in feeds))
+
+    results['handle_message_concurrent'] = measure(lambda i: loop.run_until_complete(burst()),
+                                                   max(1, args.iterations // args.chats), args.chats)
+    results['read'] = measure(lambda i: drive("/read big.txt"), args.reads)
+    # With the file's pieces in every prompt the history has less room, the start of the prompt should still be reused.
+    # Every question is different, repeating the same turn would make a sliding window look cached.
+    results['handle_message_after_read'] = prompt_reuse(fake_ollama, lambda: measure(
+        lambda i: drive(f"What does the file say in part {i}?"), args.iterations))
+
+    # First reply after /model, once the switch has loaded the new model in the background
+    def switch_and_chat(i):
+        drive(f"/model {'llama3.2:3b' if i % 2 == 0 else 'gemma3:4b'}")
+        loop.run_until_complete(asyncio.gather(*tars.background_tasks))
+        started = time.perf_counter()
+        drive("Hello again")
+        return time.perf_counter() - started
+
+    latencies = [switch_and_chat(i) for i in range(4)]
+    results['first_reply_after_model_switch'] = summarize(latencies, sum(latencies))
+
+    # Embedding index over analysis/: first build, then an update where nothing changed
+    results['reindex_full'] = measure(lambda i: tars.analysis_index.update(), 1)
+    results['reindex_unchanged'] = measure(lambda i: tars.analysis_index.update(), 5)
+    results['ask'] = measure(lambda i: drive(f"/ask What was the budget of project {i % 9}?"), args.iterations)
+
+    # /torrent with three magnet links, until the server's answer is sent. Before: a new ssh connection per link.
+    magnets = [f"magnet:?xt=urn:btih:{n:040x}" for n in range(3)]
+
+    async def ssh_per_link():
+        for link in magnets:
+            ssh = await asyncio.create_subprocess_exec("ssh", "user@server", f"torrent.py {link}")
+            await ssh.wait()
+
+    async def torrent():
+        await process([update(feed, "/torrent " + " ".join(magnets))])
+        await asyncio.gather(*tars.background_tasks)
+        await tars.outbox.drain()
+
+    results['torrent_ssh_per_link'] = measure(lambda i: loop.run_until_complete(ssh_per_link()), 3, len(magnets))
+    results['torrent_first_dispatch'] = measure(lambda i: loop.run_until_complete(torrent()), 1, len(magnets))
+    results['torrent_dispatch'] = measure(lambda i: loop.run_until_complete(torrent()), 20, len(magnets))
+    loop.run_until_complete(tars.ssh_channel.close())
+
+    # The monitor on the torrent server, watching --torrents downloads sent by three runs of torrent.py:
+    # the first one becomes the monitor, the others hand their links to it. Timed from the moment a
+    # download finishes until the user is told, qBittorrent's load is reported next to it.
+    os.environ['TORRENT_SOCKET'] = os.path.abspath('torrent.sock')
+    sys.path.insert(0, os.path.join(REPO_DIR, 'torrent_server'))
+    import torrent as torrent_monitor
+    fake_qbt = FakeQbittorrent(duration=args.download_time)
+    torrent_monitor.connect_qbt = lambda: fake_qbt
+    notifications = []
+    torrent_monitor.send_telegram_update = lambda text: notifications.append((text, time.monotonic()))
+    # Scaled down from 2-60 seconds so the case runs in a few seconds
+    torrent_monitor.MIN_POLL, torrent_monitor.MAX_POLL = 0.02, 0.6
+    links = [f"magnet:?xt=urn:btih:{n:040x}" for n in range(args.torrents)]
+    batches = [links[k::3] for k in range(3)]
+    start = time.perf_counter()
+    sys.argv = ['torrent.py'] + batches[0]
+    threading.Thread(target=torrent_monitor.main, daemon=True).start()
+    for batch in batches[1:]:
+        while not torrent_monitor.hand_off(batch):
+            time.sleep(0.01)
+    done = {torrent_monitor.info_hash(link): f"✅ file-{torrent_monitor.info_hash(link)} download 100% complete."
+            for link in links}
+    deadline = time.monotonic() + args.download_time * 3 + 10
+    while True:
+        notified = dict(reversed(notifications))
+        if all(text in notified for text in done.values()):
+            break
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"torrent monitor stopped, it sent: {list(notified)}")
+        time.sleep(0.01)
+    lags = [notified[text] - fake_qbt.finished_at(info) for info, text in done.items()]
+    results['torrent_monitor'] = summarize(lags, time.perf_counter() - start)
+    results['torrent_monitor']['qbittorrent_calls'] = fake_qbt.calls
+    results['torrent_monitor']['qbittorrent_response_bytes'] = fake_qbt.response_bytes
+    results['torrent_monitor']['telegram_messages'] = len(notifications)
+
+    # Many reminders due at the same moment, with Telegram's real limits: one message per second per chat
+    # (bursts of 3) on the bot's side, and a server that answers 429 past 3 messages a second
+    fake_telegram.rate_limit = 3
+    fast_outbox = tars.outbox
+    tars.outbox = OutboundDispatcher(tars.bot, chat_rate=1.0, chat_burst=3, global_rate=25)
+
+    async def reminders_due(n):
+        for k in range(n):
+            await tars.send_reminder_callback(USER_ID, f"stretch {k}", f"burst-{k}")
+        await tars.outbox.drain()
+
+    def reminder_burst(i):
+        loop.run_until_complete(reminders_due(args.burst))
+
+    sent_before = tars.outbox.stats['sent']
+    results['reminder_burst'] = measure(reminder_burst, 3, args.burst)
+    results['reminder_burst']['telegram_messages'] = tars.outbox.stats['sent'] - sent_before
+
+    outbox_stats = dict(tars.outbox.stats)
+
+    # Limits set higher than the server allows: the sends that can't be merged get a 429 and wait for retry_after
+    tars.outbox = OutboundDispatcher(tars.bot, chat_rate=10.0, chat_burst=10, global_rate=25)
+
+    async def separate_sends(n):
+        for k in range(n):
+            tars.outbox.send(USER_ID + 1, f"part {k}", coalesce=False)
+        await tars.outbox.drain()
+
+    results['rate_limited_sends'] = measure(lambda i: loop.run_until_complete(separate_sends(6)), 1, 6)
+    outbox_stats['retries_after_429'] = tars.outbox.stats['retries']
+    tars.outbox = fast_outbox
+    fake_telegram.rate_limit = None
+
+    # Getting updates in: long polling against the webhook server. Timed from the moment Telegram has
+    # the update until the reply is sent, for one message and for a burst from many chats at once.
+    # Every update comes from a new chat, so its reply can't be mixed up with one to an earlier update
+    chat_ids = itertools.count(USER_ID + 100)
+    update_ids = itertools.count(1)
+
+    def new_updates(count):
+        updates = []
+        for _ in range(count):
+            u = UpdateFeed(USER_ID, chat_id=next(chat_ids)).update("What's my next reminder?")
+            # Update ids are counted per bot, not per chat
+            u['update_id'] = next(update_ids)
+            updates.append(u)
+        return updates
+
+    async def ingest(deliver, count, iterations):
+        first_reply, all_replies = [], []
+        start = time.perf_counter()
+        for _ in range(iterations):
+            sent_before = len(fake_telegram.sent)
+            updates = new_updates(count)
+            chats = {u['message']['chat']['id'] for u in updates}
+            started = time.perf_counter()
+            await deliver(updates)
+            while True:
+                replies = {}
+                for _, _, sent_at, chat_id in fake_telegram.sent[sent_before:]:
+                    if chat_id in chats:
+                        replies.setdefault(chat_id, sent_at)
+                if len(replies) == len(chats):
+                    break
+                await asyncio.sleep(0.0005)
+            first_reply.append(min(replies.values()) - started)
+            all_replies.append(max(replies.values()) - started)
+        return first_reply, all_replies, time.perf_counter() - start
+
+    async def polled(count, iterations):
+        async def deliver(updates):
+            fake_telegram.push(updates)
+
+        polling = asyncio.create_task(tars.bot.infinity_polling(timeout=20, request_timeout=30))
+        try:
+            return await ingest(deliver, count, iterations)
+        finally:
+            tars.bot._polling = False
+            polling.cancel()
+            # Stopping the polling closes telebot's HTTP session, let that happen before the next case sends anything
+            await asyncio.gather(polling, return_exceptions=True)
+
+    async def webhooked(count, iterations):
+        server = WebhookServer(tars.bot, secret="bench-secret")
+        host, port = await server.start(port=0)
+        url = f"http://{host}:{port}/"
+        async with aiohttp.ClientSession(headers={SECRET_HEADER: "bench-secret"}) as session:
+            async def post(update):
+                async with session.post(url, json=update) as response:
+                    response.raise_for_status()
+
+            async def deliver(updates):
+                await asyncio.gather(*(post(u) for u in updates))
+
+            try:
+                return await ingest(deliver, count, iterations)
+            finally:
+                await server.stop()
+
+    for name, ingest_mode in (('polling', polled), ('webhook', webhooked)):
+        first_reply, _, elapsed = loop.run_until_complete(ingest_mode(1, args.iterations))
+        results[f'{name}_single_update'] = summarize(first_reply, elapsed)
+        _, all_replies, elapsed = loop.run_until_complete(ingest_mode(args.burst, 10))
+        results[f'{name}_burst'] = summarize(all_replies, elapsed, 10 * args.burst)
+
+    # Email sorter, every run on a fresh mailbox and an empty cache. The sorter keeps its services
+    # between runs, so they all share one mailbox that is refilled before each run.
+    mailbox = FakeGmailService(0, args.gmail_latency)
+
+    def fake_gmail_service():
+        service = FakeGmailService(0, args.gmail_latency)
+        service.store = mailbox.store
+        service.label_list = mailbox.label_list
+        return service
+
+    email_sorter.get_gmail_service = fake_gmail_service
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(args.sorter_runs):
+        mailbox.store.clear()
+        mailbox.store.update(FakeGmailService(args.emails, 0).store)
+        mailbox.label_list.clear()
+        email_sorter._label_map = None
+        for path in (CACHE_FILE, CACHE_FILE + '-wal', CACHE_FILE + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+        started = time.perf_counter()
+        email_sorter.sort_emails(args.emails)
+        latencies.append(time.perf_counter() - started)
+    results['email_sorter'] = summarize(latencies, time.perf_counter() - start, args.emails * args.sorter_runs)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': vars(args),
+        'results': results,
+        'requests': {'ollama': fake_ollama.requests, 'telegram': fake_telegram.calls},
+        # How much of the prompts Ollama could take from its cache
+        'prompt_tokens': {'sent': fake_ollama.prompt_tokens, 'evaluated': fake_ollama.evaluated_tokens},
+        'router': tars.router.stats(),
+        'outbox': outbox_stats,
+        'ssh': tars.ssh_channel.stats,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+    output = json.dumps(report, indent=2)
+    print(output, file=report_out)
+    report_out.flush()
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+    loop.run_until_complete(tars.bot.close_session())
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
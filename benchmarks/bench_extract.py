@@ -0,0 +1,75 @@
+"""
+Micro-benchmark of get_email_content() on large synthetic multipart emails,
+against the original recursive version that decoded every text/plain part in full.
+Usage: python benchmarks/bench_extract.py [body_megabytes] [iterations]
+"""
+import base64
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from email_sorter import get_email_content
+
+
+def legacy_get_email_content(payload):
+    # The extractor email_sorter used before, kept here as the baseline
+    body = ""
+    if 'parts' in payload:
+        for part in payload['parts']:
+            if part['mimeType'] == 'text/plain':
+                data = part['body'].get('data')
+                if data:
+                    body += base64.urlsafe_b64decode(data).decode()
+            elif 'parts' in part:
+                body += legacy_get_email_content(part)
+    elif 'body' in payload and 'data' in payload['body']:
+        data = payload['body']['data']
+        body += base64.urlsafe_b64decode(data).decode()
+    return body
+
+
+def encode(data):
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def make_payload(megabytes):
+    size = int(megabytes * 1024 * 1024)
+    text = ("Quarterly report, see the numbers below. Ünïcödé included. " * (size // 60 + 1))[:size]
+    html = "<html><body>" + "<p>" + text[:size // 2] + "</p></body></html>"
+    return {
+        'mimeType': 'multipart/mixed',
+        'parts': [
+            {'mimeType': 'multipart/alternative', 'parts': [
+                {'mimeType': 'text/plain', 'headers': [{'name': 'Content-Type', 'value': 'text/plain; charset=utf-8'}],
+                 'body': {'data': encode(text.encode())}},
+                {'mimeType': 'text/html', 'body': {'data': encode(html.encode())}},
+            ]},
+            # A log file attached as text/plain, which the old extractor decoded too
+            {'mimeType': 'text/plain', 'filename': 'server.log',
+             'headers': [{'name': 'Content-Disposition', 'value': 'attachment; filename="server.log"'}],
+             'body': {'data': encode(text.encode())}},
+            {'mimeType': 'application/pdf', 'filename': 'report.pdf', 'body': {'data': encode(os.urandom(size))}},
+        ],
+    }
+
+
+def main():
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    payload = make_payload(megabytes)
+
+    legacy = timeit.timeit(lambda: legacy_get_email_content(payload), number=iterations) / iterations
+    budgeted = timeit.timeit(lambda: get_email_content(payload), number=iterations) / iterations
+    print(f"{megabytes} MB text parts + attachments")
+    print(f"legacy:   {legacy * 1000:.2f} ms/email")
+    print(f"budgeted: {budgeted * 1000:.3f} ms/email ({legacy / budgeted:.0f}x faster)")
+
+    html_only = {'mimeType': 'text/html', 'body': payload['parts'][0]['parts'][1]['body']}
+    html = timeit.timeit(lambda: get_email_content(html_only), number=iterations) / iterations
+    print(f"html-only fallback: {html * 1000:.3f} ms/email")
+
+
+if __name__ == '__main__':
+    main()
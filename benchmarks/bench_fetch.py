@@ -0,0 +1,38 @@
+"""
+Compares one messages().get() call per email against batched fetching with fetch_messages().
+Usage: python benchmarks/bench_fetch.py [num_messages] [latency_seconds]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from email_sorter import fetch_messages
+from fake_gmail import FakeGmailService
+
+
+def main():
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+
+    service = FakeGmailService(num_messages, latency)
+    ids = list(service.store)
+
+    start = time.perf_counter()
+    for msg_id in ids:
+        service.users().messages().get(userId='me', id=msg_id).execute()
+    sequential = time.perf_counter() - start
+    print(f"sequential: {sequential:.2f}s, {service.round_trips} round trips")
+
+    for error_rate in (0.0, 0.02):
+        service = FakeGmailService(num_messages, latency, error_rate=error_rate)
+        start = time.perf_counter()
+        fetched = sum(1 for _ in fetch_messages(service, ids))
+        batched = time.perf_counter() - start
+        print(f"batched:    {batched:.2f}s, {service.round_trips} round trips, {fetched}/{num_messages} fetched, "
+              f"{error_rate:.0%} rate limit errors, {sequential / batched:.1f}x speedup")
+
+
+if __name__ == '__main__':
+    main()
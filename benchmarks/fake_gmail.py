@@ -0,0 +1,177 @@
+"""
+An in-memory stand-in for the Gmail API service object returned by build('gmail', 'v1').
+Every execute() sleeps for `latency` seconds to simulate one HTTPS round trip, so the
+sorter can be benchmarked without a Google account or network access.
+"""
+import base64
+import random
+import threading
+import time
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+
+def make_message(i, body_size=2000):
+    body = (f"Hello, this is email number {i}. " * (body_size // 30 + 1))[:body_size]
+    data = base64.urlsafe_b64encode(body.encode()).decode()
+    return {
+        'id': f"{i:016x}",
+        'threadId': f"{i:016x}",
+        'labelIds': ['UNREAD', 'INBOX'],
+        'snippet': body[:200],
+        'payload': {
+            'mimeType': 'multipart/alternative',
+            'headers': [
+                {'name': 'From', 'value': f"Sender {i % 20} <sender{i % 20}@example.com>"},
+                {'name': 'Subject', 'value': f"Test email {i}"},
+            ],
+            'parts': [
+                {'mimeType': 'text/plain', 'headers': [], 'body': {'size': len(body), 'data': data}},
+            ],
+        },
+    }
+
+
+class FakeRequest:
+    def __init__(self, service, func):
+        self.service = service
+        self.func = func
+
+    def execute(self):
+        self.service.round_trip()
+        return self.func()
+
+
+class FakeBatch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        self.service.round_trip()
+        for request_id, request in self.requests:
+            try:
+                if random.random() < self.service.error_rate:
+                    raise HttpError(httplib2.Response({'status': 429}), b'rateLimitExceeded')
+                self.callback(request_id, request.func(), None)
+            except HttpError as e:
+                self.callback(request_id, None, e)
+
+
+class FakeGmailService:
+    def __init__(self, num_messages=500, latency=0.05, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.round_trips = 0
+        self.lock = threading.Lock()
+        self.store = {}
+        self.label_list = []
+        # (historyId, message id) for every message added, used by history().list()
+        self.history_id = 1000
+        self.added = []
+        for i in range(num_messages):
+            self.add_message(make_message(i))
+
+    def add_message(self, message):
+        self.history_id += 1
+        self.store[message['id']] = message
+        self.added.append((self.history_id, message['id']))
+
+    def round_trip(self):
+        with self.lock:
+            self.round_trips += 1
+        time.sleep(self.latency)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def users(self):
+        return self
+
+    def labels(self):
+        return FakeLabels(self)
+
+    def messages(self):
+        return FakeMessages(self)
+
+    def history(self):
+        return FakeHistory(self)
+
+    def getProfile(self, userId='me'):
+        return FakeRequest(self, lambda: {'historyId': str(self.history_id)})
+
+
+class FakeLabels:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userId='me'):
+        return FakeRequest(self.service, lambda: {'labels': list(self.service.label_list)})
+
+    def create(self, userId='me', body=None):
+        def create_label():
+            label = {'id': f"Label_{len(self.service.label_list)}", 'name': body['name']}
+            self.service.label_list.append(label)
+            return label
+        return FakeRequest(self.service, create_label)
+
+
+class FakeMessages:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userId='me', q=None, maxResults=100, pageToken=None):
+        def list_page():
+            # Unread and not labeled yet, like the sorter's query
+            ids = [i for i, m in self.service.store.items()
+                   if 'UNREAD' in m['labelIds'] and not any(label.startswith('Label_') for label in m['labelIds'])]
+            start = int(pageToken or 0)
+            page = {'messages': [{'id': i, 'threadId': i} for i in ids[start:start + min(maxResults, 500)]]}
+            if start + maxResults < len(ids):
+                page['nextPageToken'] = str(start + maxResults)
+            return page
+        return FakeRequest(self.service, list_page)
+
+    def get(self, userId='me', id=None, format='full', metadataHeaders=None, fields=None):
+        def get_message():
+            message = self.service.store[id]
+            if format != 'metadata':
+                return message
+            wanted = {name.lower() for name in metadataHeaders or []}
+            headers = [h for h in message['payload']['headers'] if not wanted or h['name'].lower() in wanted]
+            return {'id': message['id'], 'labelIds': message['labelIds'], 'snippet': message['snippet'],
+                    'payload': {'headers': headers}}
+        return FakeRequest(self.service, get_message)
+
+    def batchModify(self, userId='me', body=None):
+        def modify():
+            for msg_id in body['ids']:
+                labels = self.service.store[msg_id]['labelIds']
+                labels.extend(label for label in body.get('addLabelIds', []) if label not in labels)
+            return ''
+        return FakeRequest(self.service, modify)
+
+
+class FakeHistory:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userId='me', startHistoryId=None, historyTypes=None, pageToken=None, maxResults=100):
+        def list_page():
+            added = [(h, i) for h, i in self.service.added if h > int(startHistoryId)]
+            start = int(pageToken or 0)
+            page = {
+                'history': [{'id': str(h), 'messagesAdded': [{'message': {
+                    'id': i, 'threadId': i, 'labelIds': ['UNREAD', 'INBOX']}}]}
+                    for h, i in added[start:start + maxResults]],
+                'historyId': str(self.service.history_id),
+            }
+            if start + maxResults < len(added):
+                page['nextPageToken'] = str(start + maxResults)
+            return page
+        return FakeRequest(self.service, list_page)
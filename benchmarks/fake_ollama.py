@@ -0,0 +1,187 @@
+"""
+A local stand-in for the Ollama HTTP API. Point the bot at it with OLLAMA_HOST=http://127.0.0.1:<port>
+before ollama is imported. Replies take prompt_latency per prompt token plus token_latency per
+generated token, so prompt growth and generation speed show up in benchmarks like on a real model.
+Like Ollama it keeps the last prompt of each model cached and only evaluates the part after the
+common prefix, so prompt layouts that keep the start of the prompt stable come out faster.
+The first request for a model that isn't loaded waits load_latency, and generate with
+keep_alive=0 unloads it again.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LABELS = ['ec_delete', 'ec_save', 'ec_not_sure']
+
+
+def count_tokens(text):
+    # Roughly 4 characters per token
+    return max(1, len(text) // 4)
+
+
+class FakeOllama:
+    def __init__(self, token_latency=0.002, reply_tokens=60, prompt_latency=0.00002, embedding_dim=64,
+                 load_latency=0.0):
+        self.token_latency = token_latency
+        self.reply_tokens = reply_tokens
+        self.prompt_latency = prompt_latency
+        self.embedding_dim = embedding_dim
+        self.load_latency = load_latency
+        self.loaded = set()
+        self.load_lock = threading.Lock()
+        self.requests = {}
+        # Last prompt per model, and totals of prompt tokens received and actually evaluated
+        self.cached_prompts = {}
+        self.prompt_tokens = 0
+        self.evaluated_tokens = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler_class())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def count(self, path):
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def reply_for(self, body):
+        prompt = "\n".join(m.get('content', '') for m in body.get('messages', []))
+        schema = body.get('format')
+        if isinstance(schema, dict):
+            # Batched email classification, answer every ID
+            return json.dumps({email_id: LABELS[int(hashlib.md5(email_id.encode()).hexdigest(), 16) % 3]
+                               for email_id in schema.get('required', [])})
+        if 'category name' in prompt:
+            return LABELS[int(hashlib.md5(prompt.encode()).hexdigest(), 16) % 3]
+        return " ".join(["word"] * self.reply_tokens)
+
+    def load(self, model):
+        # Models are loaded one at a time, like Ollama does
+        with self.load_lock:
+            if model not in self.loaded:
+                time.sleep(self.load_latency)
+                self.loaded.add(model)
+
+    def evaluate(self, body):
+        # Number of prompt tokens after the prefix shared with the model's previous prompt
+        prompt = "".join(f"<{m.get('role')}>{m.get('content', '')}" for m in body.get('messages', []))
+        with self.lock:
+            cached = os.path.commonprefix([prompt, self.cached_prompts.get(body.get('model'), '')])
+            self.cached_prompts[body.get('model')] = prompt
+            evaluated = max(1, count_tokens(prompt) - (count_tokens(cached) if cached else 0))
+            self.prompt_tokens += count_tokens(prompt)
+            self.evaluated_tokens += evaluated
+        return evaluated
+
+    def embed(self, text):
+        # Deterministic bag-of-words vector, similar texts get similar vectors
+        vector = [0.0] * self.embedding_dim
+        for word in text.lower().split():
+            vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % self.embedding_dim] += 1.0
+        return vector
+
+    def handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out as separate writes, without this every reply waits on a delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, data, status=200):
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                fake.count(self.path)
+                if self.path == '/api/tags':
+                    self.send_json({'models': [{'name': name, 'model': name, 'size': 1, 'digest': 'fake',
+                                                'modified_at': '2024-01-01T00:00:00Z', 'details': {}}
+                                               for name in ('gemma3:4b', 'llama3.2:3b')]})
+                elif self.path == '/api/ps':
+                    self.send_json({'models': [{'name': name, 'model': name, 'size': 1, 'digest': 'fake',
+                                                'expires_at': '2099-01-01T00:00:00Z', 'size_vram': 1}
+                                               for name in sorted(fake.loaded)]})
+                else:
+                    self.send_json({'error': 'not found'}, 404)
+
+            def do_POST(self):
+                fake.count(self.path)
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                if self.path == '/api/chat':
+                    fake.load(body.get('model'))
+                    self.chat(body)
+                elif self.path == '/api/generate':
+                    # Used to load and unload models
+                    if body.get('keep_alive') == 0:
+                        fake.loaded.discard(body.get('model'))
+                        reason = 'unload'
+                    else:
+                        fake.load(body.get('model'))
+                        reason = 'load'
+                    self.send_json({'model': body.get('model'), 'created_at': '2024-01-01T00:00:00Z',
+                                    'response': '', 'done': True, 'done_reason': reason})
+                elif self.path == '/api/embed':
+                    fake.load(body.get('model'))
+                    inputs = body.get('input', [])
+                    inputs = [inputs] if isinstance(inputs, str) else inputs
+                    time.sleep(fake.prompt_latency * sum(count_tokens(text) for text in inputs))
+                    self.send_json({'model': body.get('model'), 'embeddings': [fake.embed(t) for t in inputs]})
+                else:
+                    self.send_json({'error': 'not found'}, 404)
+
+            def chat(self, body):
+                prompt_tokens = fake.evaluate(body)
+                reply = fake.reply_for(body)
+                started = time.perf_counter()
+                time.sleep(fake.prompt_latency * prompt_tokens)
+                prompt_duration = time.perf_counter() - started
+                final = {'model': body.get('model'), 'created_at': '2024-01-01T00:00:00Z', 'done': True,
+                         'done_reason': 'stop', 'prompt_eval_count': prompt_tokens,
+                         'prompt_eval_duration': int(prompt_duration * 1e9), 'eval_count': count_tokens(reply)}
+
+                if not body.get('stream', True):
+                    time.sleep(fake.token_latency * count_tokens(reply))
+                    final['message'] = {'role': 'assistant', 'content': reply}
+                    final['total_duration'] = int((time.perf_counter() - started) * 1e9)
+                    self.send_json(final)
+                    return
+
+                # Streamed reply, one NDJSON line per token
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                words = reply.split(' ')
+                for i, word in enumerate(words):
+                    time.sleep(fake.token_latency)
+                    self.write_chunk({'model': body.get('model'), 'created_at': '2024-01-01T00:00:00Z',
+                                      'message': {'role': 'assistant', 'content': word + (' ' if i < len(words) - 1 else '')},
+                                      'done': False})
+                final['message'] = {'role': 'assistant', 'content': ''}
+                final['total_duration'] = int((time.perf_counter() - started) * 1e9)
+                self.write_chunk(final)
+                self.wfile.write(b'0\r\n\r\n')
+
+            def write_chunk(self, data):
+                line = json.dumps(data).encode() + b'\n'
+                self.wfile.write(f"{len(line):x}\r\n".encode() + line + b'\r\n')
+                self.wfile.flush()
+
+        return Handler
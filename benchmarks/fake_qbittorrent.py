@@ -0,0 +1,78 @@
+"""
+An in-memory stand-in for the qbittorrentapi.Client used by torrent_server/torrent.py.
+Every added torrent gets its metadata after `metadata_delay` seconds and then downloads at a steady
+speed for `duration` seconds. sync_maindata works like qBittorrent's: with the rid of an earlier
+answer only the fields that changed since then are returned. Counts the API calls and the size of
+the answers, so the load on qBittorrent can be compared.
+"""
+import json
+import re
+import threading
+import time
+
+
+class FakeQbittorrent:
+    def __init__(self, duration=1.0, metadata_delay=0.1, size=700 * 1024 * 1024):
+        self.duration = duration
+        self.metadata_delay = metadata_delay
+        self.size = size
+        # hash -> time it was added
+        self.added = {}
+        # rid -> the torrents as they were sent in that answer
+        self.snapshots = {}
+        self.rid = 0
+        self.calls = {}
+        self.response_bytes = 0
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def auth_log_in(self):
+        self.count('auth_log_in')
+
+    def torrents_add(self, urls, **kwargs):
+        with self.lock:
+            self.count('torrents_add')
+            for link in urls:
+                info = re.search(r'btih:([a-zA-Z0-9]+)', link).group(1).lower()
+                self.added.setdefault(info, time.monotonic())
+        return "Ok."
+
+    def finished_at(self, info):
+        # When the download is complete, on time.monotonic()'s clock
+        return self.added[info] + self.metadata_delay + self.duration
+
+    def torrent(self, info, now):
+        elapsed = now - self.added[info] - self.metadata_delay
+        if elapsed < 0:
+            # Named after the hash until the metadata arrives
+            return {'name': info, 'progress': 0, 'dlspeed': 0, 'state': 'metaDL', 'size': 0, 'eta': 8640000}
+        progress = min(elapsed / self.duration, 1.0)
+        if progress == 1.0:
+            return {'name': f"file-{info}", 'progress': 1.0, 'dlspeed': 0, 'state': 'stalledUP',
+                    'size': self.size, 'eta': 8640000}
+        speed = int(self.size / self.duration)
+        return {'name': f"file-{info}", 'progress': progress, 'dlspeed': speed, 'state': 'downloading',
+                'size': self.size, 'eta': int(self.duration - elapsed)}
+
+    def sync_maindata(self, rid=0):
+        with self.lock:
+            self.count('sync_maindata')
+            now = time.monotonic()
+            torrents = {info: self.torrent(info, now) for info in self.added}
+            previous = self.snapshots.pop(int(rid), None) if rid else None
+            self.rid += 1
+            self.snapshots[self.rid] = torrents
+            if previous is None:
+                data = {'rid': self.rid, 'full_update': True, 'torrents': torrents}
+            else:
+                changes = {}
+                for info, t in torrents.items():
+                    old = previous.get(info, {})
+                    changed = {key: value for key, value in t.items() if old.get(key) != value}
+                    if changed:
+                        changes[info] = changed
+                data = {'rid': self.rid, 'torrents': changes}
+            self.response_bytes += len(json.dumps(data))
+            return data
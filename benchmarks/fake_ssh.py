@@ -0,0 +1,77 @@
+"""
+A local stand-in for the ssh command, so /torrent can be benchmarked without a server.
+Opening a connection takes FAKE_SSH_HANDSHAKE seconds (TCP connection plus key exchange), commands sent
+over a running control master (-o ControlMaster=yes -N) skip that, like OpenSSH connection multiplexing.
+Remote commands aren't run, they are appended to the file in FAKE_SSH_LOG.
+Use it by putting an `ssh` script that runs this file first on PATH.
+"""
+import os
+import signal
+import socket
+import sys
+import time
+
+HANDSHAKE = float(os.getenv("FAKE_SSH_HANDSHAKE", 0.3))
+
+
+def parse(args):
+    options, flags, rest = {}, set(), []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == "-o":
+            key, value = args[i + 1].split("=", 1)
+            options[key] = value
+            i += 2
+        elif arg == "-O":
+            options["-O"] = args[i + 1]
+            i += 2
+        elif arg.startswith("-") and not rest:
+            flags.add(arg)
+            i += 1
+        else:
+            rest = args[i:]
+            break
+    return options, flags, rest[0], rest[1:]
+
+
+def master_running(path):
+    with socket.socket(socket.AF_UNIX) as s:
+        try:
+            s.connect(path)
+        except OSError:
+            return False
+    return True
+
+
+def serve(path):
+    # Holds the "connection" until it is terminated
+    time.sleep(HANDSHAKE)
+    server = socket.socket(socket.AF_UNIX)
+    server.bind(path)
+    server.listen()
+
+    def stop(*_):
+        os.unlink(path)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    while True:
+        server.accept()[0].close()
+
+
+def main():
+    options, flags, target, command = parse(sys.argv[1:])
+    path = options.get("ControlPath", "").replace("%C", target.replace("@", "-"))
+    if options.get("-O") == "check":
+        sys.exit(0 if path and master_running(path) else 255)
+    if options.get("ControlMaster") == "yes" and "-N" in flags:
+        serve(path)
+    if not (path and master_running(path)):
+        time.sleep(HANDSHAKE)
+    with open(os.environ["FAKE_SSH_LOG"], "a") as f:
+        f.write(" ".join(command) + "\n")
+
+
+if __name__ == "__main__":
+    main()
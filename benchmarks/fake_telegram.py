@@ -0,0 +1,154 @@
+"""
+A local stand-in for the Telegram Bot API, plus a feed of fake updates.
+Point telebot at it with telebot.apihelper.API_URL = fake.api_url before sending anything.
+"""
+import itertools
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class FakeTelegram:
+    def __init__(self, latency=0.0, rate_limit=None):
+        self.latency = latency
+        # Most messages per chat per second before answering 429 like Telegram does, None for no limit
+        self.rate_limit = rate_limit
+        self.recent = {}
+        self.rejected = 0
+        self.calls = {}
+        self.sent = []
+        # Updates waiting for getUpdates, pushed by the benchmark
+        self.updates = []
+        self.update_ready = threading.Condition()
+        self.message_ids = itertools.count(1000)
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler_class(), bind_and_activate=False)
+        self.server.daemon_threads = True
+        # The default backlog of 5 resets connections when a burst of messages goes out at once
+        self.server.request_queue_size = 128
+        self.server.server_bind()
+        self.server.server_activate()
+        self.api_url = f"http://127.0.0.1:{self.server.server_address[1]}/bot{{0}}/{{1}}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def retry_after(self, method, params):
+        # Seconds the client has to wait if this call goes over the rate limit, else 0
+        if self.rate_limit is None or method not in ('sendMessage', 'editMessageText'):
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            recent = self.recent.setdefault(params.get('chat_id'), deque())
+            while recent and now - recent[0] > 1.0:
+                recent.popleft()
+            if len(recent) >= self.rate_limit:
+                self.rejected += 1
+                return 1
+            recent.append(now)
+        return 0
+
+    def push(self, updates):
+        with self.update_ready:
+            self.updates.extend(updates)
+            self.update_ready.notify_all()
+
+    def get_updates(self, params):
+        # Long polling: answers as soon as there is an update at or after the offset, or after the timeout
+        offset = int(params.get('offset') or 0)
+        deadline = time.monotonic() + float(params.get('timeout') or 0)
+        with self.update_ready:
+            # Like Telegram, updates before the offset are confirmed and forgotten
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            while True:
+                ready = [u for u in self.updates if u['update_id'] >= offset]
+                remaining = deadline - time.monotonic()
+                if ready or remaining <= 0:
+                    return ready
+                self.update_ready.wait(remaining)
+
+    def handle(self, method, params):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        time.sleep(self.latency)
+        if method == 'getUpdates':
+            return self.get_updates(params)
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'TARS', 'username': 'tars_bot'}
+        if method in ('sendMessage', 'editMessageText'):
+            with self.lock:
+                self.sent.append((method, params.get('text', ''), time.perf_counter(), int(params.get('chat_id', 0))))
+            message_id = int(params['message_id']) if 'message_id' in params else next(self.message_ids)
+            return {'message_id': message_id, 'date': int(time.time()),
+                    'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+                    'text': params.get('text', '')}
+        return True
+
+    def handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out as separate writes, without this every reply waits on a delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                raw = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params = json.loads(raw or '{}')
+                else:
+                    params = {key: values[0] for key, values in parse_qs(raw).items()}
+                method = self.path.rsplit('/', 1)[-1].split('?')[0]
+                retry_after = fake.retry_after(method, params)
+                if retry_after:
+                    status = 429
+                    payload = json.dumps({'ok': False, 'error_code': 429,
+                                          'description': f"Too Many Requests: retry after {retry_after}",
+                                          'parameters': {'retry_after': retry_after}}).encode()
+                else:
+                    status = 200
+                    payload = json.dumps({'ok': True, 'result': fake.handle(method, params)}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+        return Handler
+
+
+class UpdateFeed:
+    """
+    Builds Telegram update JSON like the Bot API sends it, one private chat with one user.
+    """
+
+    def __init__(self, user_id, chat_id=None):
+        self.user_id = user_id
+        self.chat_id = chat_id or user_id
+        self.update_ids = itertools.count(1)
+
+    def update(self, text):
+        update_id = next(self.update_ids)
+        message = {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': self.chat_id, 'type': 'private', 'first_name': 'Cooper'},
+            'from': {'id': self.user_id, 'is_bot': False, 'first_name': 'Cooper'},
+            'text': text,
+        }
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        return {'update_id': update_id, 'message': message}
@@ -0,0 +1,156 @@
+import asyncio
+import os
+
+# Most tokens of chat history sent to the model per turn, the reply comes on top.
+# Keep it below the model's context (Ollama uses 4096 tokens unless num_ctx is changed).
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3000))
+# Once the history passes this share of the room left for it in the prompt, older messages are folded into a summary
+SUMMARY_THRESHOLD = float(os.getenv("SUMMARY_THRESHOLD", 0.75))
+# The latest messages are never folded into the summary
+KEEP_RECENT_MESSAGES = 6
+# Starting guess before the estimator has seen real token counts from Ollama
+CHARS_PER_TOKEN = 4.0
+# Tokens the chat template adds around every message
+MESSAGE_OVERHEAD = 4
+# A message is only cut down to fit the budget if at least this many tokens of it fit
+MIN_PARTIAL_TOKENS = 100
+CUT_MARKER = "\n[...cut off]"
+# Replies shorter than this many tokens are too short to calibrate the estimator with
+MIN_CALIBRATION_TOKENS = 20
+
+
+class TokenEstimator:
+    """
+    Estimates token counts from the number of characters. Starts at CHARS_PER_TOKEN and learns
+    the model's real ratio from the eval_count Ollama reports for each reply. The prompt counts can't
+    be used for this, Ollama leaves out the part of the prompt it had cached.
+    """
+
+    def __init__(self, chars_per_token=CHARS_PER_TOKEN):
+        self.chars_per_token = chars_per_token
+
+    def count(self, text):
+        return int(len(text) / self.chars_per_token) + 1
+
+    def count_messages(self, messages):
+        return sum(self.count(m['content']) + MESSAGE_OVERHEAD for m in messages)
+
+    def truncate(self, text, tokens):
+        return text[:int(tokens * self.chars_per_token)]
+
+    def calibrate(self, text, eval_count):
+        if eval_count < MIN_CALIBRATION_TOKENS:
+            return
+        ratio = len(text) / eval_count
+        # Averaged in slowly, one odd reply (like a code block) shouldn't move the estimate much
+        if 1.0 <= ratio <= 8.0:
+            self.chars_per_token = 0.8 * self.chars_per_token + 0.2 * ratio
+
+
+# One estimator per model, tokenizers differ between model families
+estimators = {}
+
+
+def get_estimator(model):
+    if model not in estimators:
+        estimators[model] = TokenEstimator()
+    return estimators[model]
+
+
+class ChatSession:
+    """
+    History of one Telegram chat. Handlers hold `lock` while they read or change the history,
+    so two messages in the same chat are answered one after the other instead of mixing their turns.
+    The full history is kept, prompt() picks the newest messages that fit the token budget and
+    older messages are folded into `summary` in the background.
+    """
+
+    def __init__(self, system_prompt):
+        self.history = [{'role': 'system', 'content': system_prompt}]
+        self.summary = ""
+        # DocumentIndex of the file loaded with /read
+        self.document = None
+        self.lock = asyncio.Lock()
+        self.compacting = False
+        # Size of the last prompt, estimated and as counted by Ollama
+        self.prompt_tokens = 0
+        self.prompt_eval_count = None
+        # Tokens the last prompt had left for the history, after the system prompt, summary and extra messages
+        self.history_room = None
+
+    def add(self, role, content):
+        self.history.append({'role': role, 'content': content})
+
+    def reset(self):
+        self.history = [self.history[0]]  # Keep only the system prompt
+        self.summary = ""
+        self.document = None
+
+    def prompt(self, estimator, budget=CONTEXT_TOKEN_BUDGET, extra=()):
+        """
+        The messages to send: system prompt, summary and as many of the newest messages as fit in `budget`.
+        `extra` messages (like parts of a file from /read) go right before the newest message
+        and aren't kept in the history.
+        """
+        system = [self.history[0]]
+        if self.summary:
+            system.append({'role': 'system', 'content': f"Summary of the earlier conversation:\n{self.summary}"})
+        remaining = budget - estimator.count_messages(system) - estimator.count_messages(extra)
+        self.history_room = remaining
+        recent = []
+        for message in reversed(self.history[1:]):
+            tokens = estimator.count_messages([message])
+            if tokens > remaining:
+                # The newest message that doesn't fit (like a long pasted text) is cut to the space left
+                space = remaining - MESSAGE_OVERHEAD - estimator.count(CUT_MARKER) - 1
+                if space >= MIN_PARTIAL_TOKENS:
+                    content = estimator.truncate(message['content'], space)
+                    recent.append({'role': message['role'], 'content': content + CUT_MARKER})
+                break
+            recent.append(message)
+            remaining -= tokens
+        recent = recent[::-1]
+        messages = system + recent[:-1] + list(extra) + recent[-1:]
+        self.prompt_tokens = estimator.count_messages(messages)
+        return messages
+
+    def take_old_messages(self, estimator, budget=CONTEXT_TOKEN_BUDGET):
+        """
+        The messages to fold into the summary, or None while the history is small enough.
+        Measured against the room the last prompt had for the history, so the summary is written
+        before prompt() has to leave messages out (which would also change the start of the prompt).
+        """
+        room = budget if self.history_room is None else self.history_room
+        if self.compacting or estimator.count_messages(self.history[1:]) <= room * SUMMARY_THRESHOLD:
+            return None
+        old = self.history[1:-KEEP_RECENT_MESSAGES]
+        if not old:
+            return None
+        self.compacting = True
+        return old
+
+    def fold(self, old, summary):
+        """
+        Replaces the messages returned by take_old_messages() with the new summary.
+        """
+        folded = {id(m) for m in old}
+        # The history was reset while the summary was written
+        if not any(id(m) in folded for m in self.history):
+            return
+        self.history = [self.history[0]] + [m for m in self.history[1:] if id(m) not in folded]
+        self.summary = summary
+
+
+class SessionStore:
+    """
+    One ChatSession per chat ID, created on first use.
+    """
+
+    def __init__(self, system_prompt):
+        self.system_prompt = system_prompt
+        self.sessions = {}
+
+    def get(self, chat_id):
+        if chat_id not in self.sessions:
+            self.sessions[chat_id] = ChatSession(self.system_prompt)
+        return self.sessions[chat_id]
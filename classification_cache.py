@@ -0,0 +1,124 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+
+# SQLite file that stores the email classifications between runs
+CACHE_FILE = "classification_cache.db"
+# How much of the body goes into the fingerprint. Newsletters usually differ further down.
+FINGERPRINT_CHARS = 300
+# Run the LRU eviction every this many writes instead of on every write
+EVICT_EVERY = 100
+
+
+def normalize(text):
+    """
+    Lowercases, replaces numbers and collapses whitespace so order numbers, dates
+    and counters in otherwise identical emails produce the same fingerprint.
+    """
+    text = re.sub(r'\d+', '#', text.lower())
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def sender_address(sender):
+    # "Name <news@shop.com>" -> "news@shop.com"
+    match = re.search(r'<([^>]+)>', sender)
+    return (match.group(1) if match else sender).strip().lower()
+
+
+def fingerprint(sender, subject, body):
+    text = "\n".join([sender_address(sender), normalize(subject), normalize(body[:FINGERPRINT_CHARS])])
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class ClassificationCache:
+    """
+    Persistent cache of email classifications, keyed by a fingerprint of sender + subject + body prefix.
+    Entries expire after ttl seconds and the least recently used ones are evicted past max_entries.
+    The whole cache is cleared when `version` changes, so a new model or prompt starts from scratch.
+    With sender_verdicts enabled, a sender whose last `sender_min_votes` emails all got the same
+    label is given that label without looking at the email at all.
+    """
+
+    def __init__(self, path=CACHE_FILE, version="", max_entries=50000, ttl=30 * 24 * 3600,
+                 sender_verdicts=False, sender_min_votes=3):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sender_verdicts = sender_verdicts
+        self.sender_min_votes = sender_min_votes
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        # The sorter's classify workers share one connection
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS entries "
+                              "(key TEXT PRIMARY KEY, label TEXT, created REAL, last_used REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS senders "
+                              "(sender TEXT PRIMARY KEY, label TEXT, votes INTEGER, updated REAL)")
+
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+            if row is None or row[0] != version:
+                # Model or prompt changed, old answers can't be trusted anymore
+                self.conn.execute("DELETE FROM entries")
+                self.conn.execute("DELETE FROM senders")
+                self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+
+    def get(self, sender, subject, body):
+        """
+        Returns the cached label for this email, or None on a miss.
+        """
+        now = time.time()
+        with self.lock, self.conn:
+            if self.sender_verdicts:
+                row = self.conn.execute("SELECT label, votes, updated FROM senders WHERE sender = ?",
+                                        (sender_address(sender),)).fetchone()
+                if row and row[1] >= self.sender_min_votes and now - row[2] < self.ttl:
+                    self.hits += 1
+                    return row[0]
+
+            key = fingerprint(sender, subject, body)
+            row = self.conn.execute("SELECT label, created FROM entries WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] < self.ttl:
+                self.conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (now, key))
+                self.hits += 1
+                return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, sender, subject, body, label):
+        now = time.time()
+        address = sender_address(sender)
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                              (fingerprint(sender, subject, body), label, now, now))
+
+            # A sender keeps its votes only while every email gets the same label
+            row = self.conn.execute("SELECT label, votes FROM senders WHERE sender = ?", (address,)).fetchone()
+            votes = row[1] + 1 if row and row[0] == label else 1
+            self.conn.execute("INSERT OR REPLACE INTO senders VALUES (?, ?, ?, ?)", (address, label, votes, now))
+
+            self.writes += 1
+            if self.writes % EVICT_EVERY == 0:
+                self.evict(now)
+
+    def evict(self, now):
+        # Called with the lock held
+        self.conn.execute("DELETE FROM entries WHERE created < ?", (now - self.ttl,))
+        self.conn.execute("DELETE FROM senders WHERE updated < ?", (now - self.ttl,))
+        self.conn.execute("DELETE FROM entries WHERE key IN "
+                          "(SELECT key FROM entries ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                          (self.max_entries,))
+
+    def close(self):
+        with self.lock:
+            self.evict(time.time())
+            self.conn.commit()
+            self.conn.close()
@@ -0,0 +1,106 @@
+import os
+import re
+
+import numpy as np
+
+# Size of the pieces a file is split into, only the best matching pieces go into the prompt
+CHUNK_CHARS = int(os.getenv("READ_CHUNK_CHARS", 1200))
+# How many pieces of the file are sent with each question
+READ_TOP_K = int(os.getenv("READ_TOP_K", 4))
+# BM25 parameters, the usual defaults
+K1 = 1.5
+B = 0.75
+
+WORD = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return WORD.findall(text.lower())
+
+
+def split_chunks(text, chunk_chars=CHUNK_CHARS):
+    """
+    Splits text into pieces of at most chunk_chars, on line breaks where possible.
+    """
+    chunks = []
+    current = []
+    size = 0
+    for line in text.splitlines(keepends=True):
+        # A single line longer than a chunk is cut into chunk-sized pieces
+        while len(line) > chunk_chars:
+            if current:
+                chunks.append("".join(current))
+                current, size = [], 0
+            chunks.append(line[:chunk_chars])
+            line = line[chunk_chars:]
+        if size + len(line) > chunk_chars and current:
+            chunks.append("".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line)
+    if current:
+        chunks.append("".join(current))
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+class DocumentIndex:
+    """
+    BM25 index over the chunks of one file. The BM25 weight of every (word, chunk) pair is computed
+    once when the index is built and stored sorted by word, so a question only sums the weights
+    of its own words with np.bincount.
+    """
+
+    def __init__(self, name, text, chunk_chars=CHUNK_CHARS):
+        self.name = name
+        self.chunks = split_chunks(text, chunk_chars)
+        self.vocabulary = {}
+        n = len(self.chunks)
+
+        token_ids = []
+        lengths = np.zeros(n, dtype=np.int64)
+        for i, chunk in enumerate(self.chunks):
+            ids = [self.vocabulary.setdefault(word, len(self.vocabulary)) for word in tokenize(chunk)]
+            token_ids.extend(ids)
+            lengths[i] = len(ids)
+        token_ids = np.array(token_ids, dtype=np.int64)
+        token_chunks = np.repeat(np.arange(n, dtype=np.int64), lengths)
+
+        # Count every (word, chunk) pair, sorted by word and then chunk
+        pairs, tf = np.unique(token_ids * max(n, 1) + token_chunks, return_counts=True)
+        words, self.posting_chunks = np.divmod(pairs, max(n, 1))
+        # Postings of word w are posting_chunks[starts[w]:starts[w + 1]]
+        self.starts = np.searchsorted(words, np.arange(len(self.vocabulary) + 1))
+
+        df = np.diff(self.starts)
+        idf = np.log(1 + (n - df + 0.5) / (df + 0.5))
+        average_length = lengths.mean() if n else 0.0
+        norm = K1 * (1 - B + B * lengths[self.posting_chunks] / max(average_length, 1.0))
+        self.weights = idf[words] * tf * (K1 + 1) / (tf + norm)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "r", errors="replace") as f:
+            return cls(os.path.basename(path), f.read())
+
+    def scores(self, query):
+        ids = {self.vocabulary[word] for word in tokenize(query) if word in self.vocabulary}
+        if not ids:
+            return np.zeros(len(self.chunks))
+        postings = np.concatenate([np.arange(self.starts[i], self.starts[i + 1]) for i in ids])
+        return np.bincount(self.posting_chunks[postings], weights=self.weights[postings],
+                           minlength=len(self.chunks))
+
+    def search(self, query, k=READ_TOP_K):
+        """
+        The k chunks that match the query best, in the order they appear in the file.
+        Questions that match nothing (like "summarize this") get the start of the file.
+        """
+        scores = self.scores(query)
+        k = min(k, len(self.chunks))
+        if k == 0:
+            return []
+        if not scores.any():
+            return self.chunks[:k]
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[scores[best] > 0]
+        return [self.chunks[i] for i in sorted(best)]
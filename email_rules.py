@@ -0,0 +1,77 @@
+import json
+import os
+import re
+
+# Optional JSON file with your own rules, replaces DEFAULT_RULES when it exists
+RULES_FILE = os.getenv("EMAIL_RULES_FILE", "email_rules.json")
+# How far the best label has to be ahead of the runner-up before the rules decide on their own
+RULE_THRESHOLD = float(os.getenv("RULE_THRESHOLD", 0.85))
+
+# Each rule adds its confidence to a label when the header is present and matches the pattern
+# (no pattern means any value). Confidences of the same label are combined, so two weak
+# signals together can be enough while one alone is not.
+DEFAULT_RULES = [
+    {'name': 'list_unsubscribe', 'header': 'List-Unsubscribe', 'label': 'ec_delete', 'confidence': 0.6},
+    {'name': 'list_id', 'header': 'List-Id', 'label': 'ec_delete', 'confidence': 0.4},
+    {'name': 'bulk_precedence', 'header': 'Precedence', 'pattern': r'^\s*(bulk|list|junk)\s*$',
+     'label': 'ec_delete', 'confidence': 0.7},
+    # Bounce addresses of the big email service providers
+    {'name': 'esp_return_path', 'header': 'Return-Path',
+     'pattern': r'@([\w.-]+\.)?(mcsv\.net|mcdlv\.net|rsgsv\.net|mailchimpapp\.net|sendgrid\.net|mailgun\.org|'
+                r'exacttarget\.com|klaviyomail\.com|hubspotemail\.net|constantcontact\.com|cmail\d*\.com|'
+                r'sailthru\.com|mktomail\.com|bnc\.salesforce\.com|sparkpostmail\.com|mandrillapp\.com)>?\s*$',
+     'label': 'ec_delete', 'confidence': 0.7},
+    {'name': 'esp_campaign_header', 'header': 'X-Campaign', 'label': 'ec_delete', 'confidence': 0.5},
+    {'name': 'mailchimp_header', 'header': 'X-MC-User', 'label': 'ec_delete', 'confidence': 0.5},
+    # Keeps receipts and bookings sent through newsletter tools away from ec_delete
+    {'name': 'transactional_subject', 'header': 'Subject',
+     'pattern': r'\b(receipt|invoice|statement|order confirm\w*|your order|reservation|itinerary|booking|'
+                r'payment|tax)\b',
+     'label': 'ec_save', 'confidence': 0.6},
+]
+
+
+def load_rules(path=RULES_FILE):
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            return json.load(f)
+    return DEFAULT_RULES
+
+
+class HeaderClassifier:
+    """
+    Rule-based first tier of the email sorter. Labels the obvious cases from the headers alone
+    and returns None for everything else, which then goes to the LLM.
+    """
+
+    def __init__(self, rules=None, threshold=RULE_THRESHOLD):
+        self.threshold = threshold
+        self.rules = []
+        rules = load_rules() if rules is None else rules
+        # The headers the rules need, so the sorter can download just those
+        self.header_names = sorted({rule['header'] for rule in rules})
+        for rule in rules:
+            pattern = re.compile(rule['pattern'], re.IGNORECASE) if rule.get('pattern') else None
+            self.rules.append((rule['header'].lower(), pattern, rule['label'], rule['confidence']))
+
+    def classify(self, headers):
+        values = {}
+        for h in headers:
+            values.setdefault(h['name'].lower(), []).append(h['value'])
+
+        scores = {}
+        for header, pattern, label, confidence in self.rules:
+            header_values = values.get(header)
+            if not header_values:
+                continue
+            if pattern is None or any(pattern.search(value) for value in header_values):
+                # Chance that at least one of the matching rules is right
+                scores[label] = 1 - (1 - scores.get(label, 0.0)) * (1 - confidence)
+
+        if not scores:
+            return None
+        ranked = sorted(scores.values(), reverse=True)
+        runner_up = ranked[1] if len(ranked) > 1 else 0.0
+        if ranked[0] - runner_up >= self.threshold:
+            return max(scores, key=scores.get)
+        return None
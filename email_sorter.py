@@ -1,13 +1,25 @@
 import os.path
 import base64
+import hashlib
+import json
+import re
+from html import unescape
+import time
+import random
+import queue
+import threading
+from contextlib import contextmanager
 import ollama
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 import sys
 import requests
 from dotenv import load_dotenv
+from classification_cache import ClassificationCache
+from email_rules import HeaderClassifier
 
 # telergram bot token and telegram user id from .env file
 load_dotenv()
@@ -15,33 +27,142 @@ load_dotenv()
 # If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 
+# Gmail accepts up to 100 calls per batch request, but recommends 50 to stay under the per-user rate limit.
+BATCH_SIZE = 50
+# How many times a rate-limited or failed batch item is retried before we give up on it.
+MAX_RETRIES = 5
+# First wait before retrying rate-limited batch items, doubled every round
+FETCH_RETRY_DELAY = 0.25
+# batchModify accepts up to 1000 IDs. Label decisions are flushed when a label reaches this many IDs,
+# or when LABEL_FLUSH_SECONDS have passed since the last flush, whichever comes first.
+LABEL_FLUSH_SIZE = 1000
+LABEL_FLUSH_SECONDS = 30
+# Number of concurrent ollama.chat calls. Ollama only runs them in parallel up to its OLLAMA_NUM_PARALLEL setting.
+OLLAMA_WORKERS = int(os.getenv("OLLAMA_WORKERS", 2))
+# Max emails waiting between two pipeline stages, this keeps memory flat on big runs.
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 100))
+
+# Or use a different model
+SORTER_MODEL = os.getenv("SORTER_MODEL", "gemma3:4b")
+CLASSIFY_PROMPT = """
+    You are an email assistant. Your job is to classify emails into one of three categories:
+    1. 'ec_delete': Promotional, marketing, newsletters, spam, or advertising.
+    2. 'ec_save': Important documents, bank statements, receipts, receipts for food, travel reservations, personal correspondence.
+    3. 'ec_not_sure': Anything ambiguous or mixed.
+
+    Here is the email:
+    Sender: {sender}
+    Subject: {subject}
+    Body Snippet: {body} (truncated)
+
+    Reply ONLY with the category name. Do not explain.
+    """
+# How many emails go into one Ollama request. 1 sends every email on its own.
+CLASSIFY_BATCH_SIZE = int(os.getenv("CLASSIFY_BATCH_SIZE", 1))
+BATCH_PROMPT = """
+    You are an email assistant. Your job is to classify emails into one of three categories:
+    1. 'ec_delete': Promotional, marketing, newsletters, spam, or advertising.
+    2. 'ec_save': Important documents, bank statements, receipts, receipts for food, travel reservations, personal correspondence.
+    3. 'ec_not_sure': Anything ambiguous or mixed.
+
+    Here are the emails, each one starts with its ID:
+    {emails}
+
+    Reply ONLY with a JSON object that maps every email ID to its category name. Do not explain.
+    """
+BATCH_EMAIL = """
+    [Email ID: {email_id}]
+    Sender: {sender}
+    Subject: {subject}
+    Body Snippet: {body} (truncated)
+"""
+VALID_LABELS = ['ec_delete', 'ec_save', 'ec_not_sure']
+# Cached classifications are thrown away when the model, the prompt or what the key is made of changes
+CACHE_KEY = "sender+subject+snippet"
+CACHE_VERSION = hashlib.sha256(
+    f"{SORTER_MODEL}\n{CLASSIFY_PROMPT}\n{BATCH_PROMPT}\n{BATCH_EMAIL}\n{CACHE_KEY}".encode()).hexdigest()
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 50000))
+CACHE_TTL_DAYS = float(os.getenv("CACHE_TTL_DAYS", 30))
+# Label every email from a sender the same way once its last 3 emails all got the same label
+CACHE_SENDER_VERDICTS = os.getenv("CACHE_SENDER_VERDICTS", "0") == "1"
+
+# Partial responses for the two fetch phases. The metadata phase is all the rules and the cache need,
+# the full payload is only downloaded for emails that go to the LLM.
+METADATA_FIELDS = 'id,labelIds,snippet,payload/headers'
+FULL_FIELDS = 'id,payload'
+
+# Last processed mailbox historyId for --sync runs
+SYNC_STATE_FILE = "sorter_state.json"
+# Unread mail the sorter hasn't labeled yet
+UNSORTED_QUERY = 'is:unread -label:ec_delete -label:ec_save -label:ec_not_sure'
+
+# Only this much of an email's body is sent to the LLM, so only this much is decoded
+BODY_CHARS = 1000
+# How many characters of HTML are decoded per character of text needed, for HTML-only emails
+HTML_OVERHEAD = 10
+
+# Put on a queue to tell the next stage there is nothing more coming
+DONE = object()
+
+
+# The bot imports this module and sorts in-process, so the credentials, the built services and
+# the label IDs below are kept warm for the whole process instead of being rebuilt every run.
+_creds = None
+_creds_lock = threading.Lock()
+# Built services that aren't in use. A service is only ever used by one thread at a time.
+_service_pool = []
+_service_pool_lock = threading.Lock()
+_label_map = None
+
+
+def get_credentials():
+    global _creds
+    with _creds_lock:
+        if _creds is None and os.path.exists('token.json'):
+            _creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+        # If there are no (valid) credentials available, let the user log in.
+        if not _creds or not _creds.valid:
+            if _creds and _creds.expired and _creds.refresh_token:
+                _creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    'credentials.json', SCOPES)
+                _creds = flow.run_local_server(port=0)
+            # Save the credentials for the next run
+            with open('token.json', 'w') as token:
+                token.write(_creds.to_json())
+        return _creds
+
 
 def get_gmail_service():
-    creds = None
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        # Save the credentials for the next run
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
+    return build('gmail', 'v1', credentials=get_credentials())
 
-    return build('gmail', 'v1', credentials=creds)
+
+@contextmanager
+def gmail_service():
+    """
+    Lends out a Gmail service from the pool, building one only if all of them are in use.
+    Building parses the whole discovery document, so reusing services makes later runs start instantly.
+    """
+    with _service_pool_lock:
+        service = _service_pool.pop() if _service_pool else None
+    if service is None:
+        service = get_gmail_service()
+    try:
+        yield service
+    finally:
+        with _service_pool_lock:
+            _service_pool.append(service)
 
 
-def get_or_create_label_id(service, label_name):
+def get_or_create_label_id(service, label_name, labels=None):
     """
     Checks if a label exists, returns its ID.
     If not, creates it and returns the new ID.
     """
-    results = service.users().labels().list(userId='me').execute()
-    labels = results.get('labels', [])
+    if labels is None:
+        results = service.users().labels().list(userId='me').execute()
+        labels = results.get('labels', [])
 
     for label in labels:
         if label['name'].lower() == label_name.lower():
@@ -54,141 +175,664 @@ def get_or_create_label_id(service, label_name):
     return created_label['id']
 
 
-def get_email_content(payload):
+def get_label_map(service):
     """
-    Recursively extracts text from email payload.
-    Prioritizes plain text, falls back to parsing snippets if complex.
+    Returns the IDs of our three labels, creating them if needed. Looked up once per process.
     """
-    body = ""
-    if 'parts' in payload:
-        for part in payload['parts']:
-            if part['mimeType'] == 'text/plain':
-                data = part['body'].get('data')
-                if data:
-                    body += base64.urlsafe_b64decode(data).decode()
-            elif 'parts' in part:  # Nested parts
-                body += get_email_content(part)
-    elif 'body' in payload and 'data' in payload['body']:
-        data = payload['body']['data']
-        body += base64.urlsafe_b64decode(data).decode()
+    global _label_map
+    if _label_map is None:
+        labels = service.users().labels().list(userId='me').execute().get('labels', [])
+        _label_map = {label_name: get_or_create_label_id(service, label_name, labels) for label_name in VALID_LABELS}
+    return _label_map
 
-    return body
 
+def load_sync_state():
+    if os.path.exists(SYNC_STATE_FILE):
+        with open(SYNC_STATE_FILE, "r") as f:
+            return json.load(f)
+    return {}
 
-def analyze_email(subject, sender, body):
+
+def save_sync_state(state):
+    with open(SYNC_STATE_FILE, "w") as f:
+        json.dump(state, f, indent=4)
+
+
+def list_unsorted(service, max_count):
     """
-    Sends email context to Ollama (gemma3:4b) for classification.
+    Full scan: pages through the unread emails that don't have one of our labels yet.
     """
-    prompt = f"""
-    You are an email assistant. Your job is to classify emails into one of three categories:
-    1. 'ec_delete': Promotional, marketing, newsletters, spam, or advertising.
-    2. 'ec_save': Important documents, bank statements, receipts, receipts for food, travel reservations, personal correspondence.
-    3. 'ec_not_sure': Anything ambiguous or mixed.
+    msg_ids = []
+    page_token = None
+    while len(msg_ids) < max_count:
+        # messages.list returns at most 500 IDs per page
+        results = service.users().messages().list(
+            userId='me', q=UNSORTED_QUERY, maxResults=min(500, max_count - len(msg_ids)), pageToken=page_token
+        ).execute()
+        msg_ids += [msg['id'] for msg in results.get('messages', [])]
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    return msg_ids
 
-    Here is the email:
-    Sender: {sender}
-    Subject: {subject}
-    Body Snippet: {body[:1000]} (truncated)
 
-    Reply ONLY with the category name. Do not explain.
+def list_added_since(service, history_id, max_count):
+    """
+    Incremental sync: returns the IDs of up to max_count unread emails added since history_id and the
+    historyId to continue from. That's the mailbox's latest historyId when every new email fit, otherwise
+    the last history record whose emails all made it into the list, so the next run starts right after them.
+    Raises HttpError 404 when history_id is too old for Gmail to still have its history.
+    """
+    msg_ids = []
+    seen = set()
+    position = history_id
+    page_token = None
+    while True:
+        results = service.users().history().list(
+            userId='me', startHistoryId=history_id, historyTypes=['messageAdded'], pageToken=page_token
+        ).execute()
+        for record in results.get('history', []):
+            new_ids = []
+            for added in record.get('messagesAdded', []):
+                message = added['message']
+                labels = message.get('labelIds', [])
+                if message['id'] in seen or 'UNREAD' not in labels:
+                    continue
+                if 'SPAM' in labels or 'TRASH' in labels or 'DRAFT' in labels:
+                    continue
+                seen.add(message['id'])
+                new_ids.append(message['id'])
+            if len(msg_ids) + len(new_ids) > max_count:
+                # A record is taken whole or not at all. Gmail adds one email per record, a record
+                # with more than max_count of them is sorted in part and read again next time.
+                return (msg_ids or new_ids[:max_count]), position
+            msg_ids += new_ids
+            position = record['id']
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return msg_ids, results['historyId']
+
+
+def list_messages(service, max_count, sync):
+    """
+    Picks the emails to sort. Returns their IDs and the historyId to save after the run
+    (None when the sync state shouldn't move).
+    With sync, only emails added since the last saved historyId are returned. Without a saved
+    historyId, or once Gmail has expired it, it falls back to a full scan.
+    """
+    if not sync:
+        return list_unsorted(service, max_count), None
+
+    history_id = load_sync_state().get('history_id')
+    if history_id:
+        try:
+            return list_added_since(service, history_id, max_count)
+        except HttpError as e:
+            if getattr(e.resp, 'status', None) != 404:
+                raise
+            print("Saved history ID has expired, falling back to a full scan.")
+
+    # Read the position before scanning so mail that arrives during the run is picked up next time
+    latest_history_id = service.users().getProfile(userId='me').execute()['historyId']
+    msg_ids = list_unsorted(service, max_count)
+    # A scan that stopped at max_count didn't see every unsorted email. Moving the position now would
+    # hide the rest from later sync runs, so it stays put and the next run scans again.
+    return msg_ids, latest_history_id if len(msg_ids) < max_count else None
+
+
+def is_retryable(error):
+    """
+    Returns True for errors that are worth retrying (rate limits and transient server errors).
+    """
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    if status in (429, 500, 502, 503, 504):
+        return True
+    # Gmail reports per-user rate limits as 403 rateLimitExceeded / userRateLimitExceeded
+    return status == 403 and 'ratelimitexceeded' in str(error).lower()
+
+
+def fetch_messages(service, msg_ids, batch_size=BATCH_SIZE, **get_kwargs):
+    """
+    Fetches messages using Gmail batch requests, one HTTPS round trip per batch instead of per message.
+    Yields (msg_id, msg_detail) as the batches come back, in the order of msg_ids except for retried items.
+    Rate-limited items are collected over all batches and retried together after one exponential backoff
+    per round, so a few 429s cost one short wait instead of one per batch. Items that fail for any other
+    reason are skipped.
+    """
+    pending = list(msg_ids)
+    attempt = 0
+    while pending:
+        retry = []
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+            results = {}
+            failed = []
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    results[request_id] = response
+                elif is_retryable(exception):
+                    failed.append(request_id)
+                else:
+                    print(f"Error fetching message {request_id}: {exception}")
+
+            batch = service.new_batch_http_request(callback=callback)
+            for msg_id in chunk:
+                batch.add(service.users().messages().get(userId='me', id=msg_id, **get_kwargs), request_id=msg_id)
+            try:
+                batch.execute()
+            except HttpError as e:
+                # The whole batch was rejected, retry everything that hasn't come back yet
+                if not is_retryable(e):
+                    raise
+                failed = [msg_id for msg_id in chunk if msg_id not in results]
+            retry += failed
+
+            for msg_id in chunk:
+                if msg_id in results:
+                    yield msg_id, results[msg_id]
+
+        if not retry:
+            break
+        if attempt >= MAX_RETRIES:
+            print(f"Giving up on {len(retry)} messages after {MAX_RETRIES} retries.")
+            break
+        time.sleep(min(FETCH_RETRY_DELAY * 2 ** attempt, 32) + random.random() * FETCH_RETRY_DELAY)
+        attempt += 1
+        pending = retry
+
+
+class LabelWriteBuffer:
+    """
+    Collects label decisions per label and applies them with one batchModify call per label,
+    instead of one call per email. A crash loses at most one unflushed buffer of decisions.
+    """
+
+    def __init__(self, service, label_map, flush_size=LABEL_FLUSH_SIZE, flush_seconds=LABEL_FLUSH_SECONDS):
+        self.service = service
+        self.label_map = label_map
+        self.flush_size = min(flush_size, 1000)
+        self.flush_seconds = flush_seconds
+        self.pending = {label_name: [] for label_name in label_map}
+        self.last_flush = time.monotonic()
+        self.write_calls = 0
+
+    def add(self, msg_id, label_name):
+        self.pending[label_name].append(msg_id)
+        if len(self.pending[label_name]) >= self.flush_size:
+            self.flush_label(label_name)
+        elif time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush_label(self, label_name):
+        ids = self.pending[label_name]
+        if not ids:
+            return
+        attempt = 0
+        while True:
+            try:
+                self.service.users().messages().batchModify(
+                    userId='me',
+                    body={
+                        'ids': ids,
+                        'addLabelIds': [self.label_map[label_name]]
+                    }
+                ).execute()
+                self.write_calls += 1
+                break
+            except HttpError as e:
+                if not is_retryable(e) or attempt >= MAX_RETRIES:
+                    raise
+                time.sleep(min(2 ** attempt, 32) + random.random())
+                attempt += 1
+        self.pending[label_name] = []
+
+    def flush(self):
+        for label_name in self.pending:
+            self.flush_label(label_name)
+        self.last_flush = time.monotonic()
+
+
+def get_part_header(part, name):
+    return next((h['value'] for h in part.get('headers', []) if h['name'].lower() == name), "")
+
+
+def is_attachment(part):
+    return bool(part.get('filename')) or 'attachment' in get_part_header(part, 'content-disposition').lower()
+
+
+def decode_part(part, max_chars):
+    """
+    Decodes the start of a part's body, at most enough base64 for max_chars characters,
+    using the charset from the part's Content-Type (UTF-8 if it has none or an unknown one).
+    """
+    data = part.get('body', {}).get('data')
+    if not data:
+        return ""
+    # A character is at most 4 bytes in UTF-8, and every 4 base64 characters hold 3 bytes
+    max_bytes = max_chars * 4
+    data = data[:(max_bytes + 2) // 3 * 4]
+    raw = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+    charset = re.search(r'charset="?([\w.:-]+)', get_part_header(part, 'content-type'), re.IGNORECASE)
+    try:
+        text = raw.decode(charset.group(1) if charset else 'utf-8', errors='replace')
+    except LookupError:
+        text = raw.decode('utf-8', errors='replace')
+    return text[:max_chars]
+
+
+def html_to_text(html):
+    """
+    Cheap HTML to text: drops scripts/styles and tags, keeps line breaks, unescapes entities.
+    """
+    html = re.sub(r'(?is)<(script|style|head)\b.*?</\1\s*>', ' ', html)
+    html = re.sub(r'(?i)<br\s*/?>|</(p|div|tr|li|h\d)\s*>', '\n', html)
+    text = unescape(re.sub(r'<[^>]*>', ' ', html))
+    text = re.sub(r'[ \t\r\f\v\xa0]+', ' ', text)
+    return re.sub(r' ?\n[ \n]*', '\n', text).strip()
+
+
+def get_email_content(payload, max_chars=BODY_CHARS):
     """
+    Extracts up to max_chars characters of text from an email payload.
+    Walks the part tree in order without recursion and stops as soon as it has enough text.
+    Prioritizes plain text parts, skips attachments and falls back to the first HTML part
+    converted to text when there is no plain text.
+    """
+    chunks = []
+    remaining = max_chars
+    html_part = None
+    stack = [payload]
+    while stack and remaining > 0:
+        part = stack.pop()
+        if part.get('parts'):
+            stack.extend(reversed(part['parts']))
+            continue
+        if is_attachment(part):
+            continue
+        if part.get('mimeType') == 'text/plain':
+            text = decode_part(part, remaining)
+            chunks.append(text)
+            remaining -= len(text)
+        elif part.get('mimeType') == 'text/html' and html_part is None:
+            html_part = part
+
+    if not chunks and html_part is not None:
+        # Markup takes up most of an HTML email, decode a bigger piece to end up with enough text
+        return html_to_text(decode_part(html_part, max_chars * HTML_OVERHEAD))[:max_chars]
+    return "".join(chunks)
+
+
+def analyze_email(subject, sender, body):
+    """
+    Sends email context to Ollama (gemma3:4b) for classification.
+    Returns None if Ollama couldn't be reached, so the failure isn't cached as an answer.
+    """
+    prompt = CLASSIFY_PROMPT.format(sender=sender, subject=subject, body=body[:BODY_CHARS])
 
     try:
-        #Or use a different model
-        response = ollama.chat(model='gemma3:4b', messages=[
+        response = ollama.chat(model=SORTER_MODEL, messages=[
             {'role': 'user', 'content': prompt},
         ])
         decision = response['message']['content'].strip()
 
         # Clean up response to ensure it matches a valid label
-        valid_labels = ['ec_delete', 'ec_save', 'ec_not_sure']
-        for label in valid_labels:
+        for label in VALID_LABELS:
             if label in decision:
                 return label
         return 'ec_not_sure'  # Default fallback
     except Exception as e:
         print(f"Ollama Error: {e}")
-        return 'ec_not_sure'
+        return None
 
 
-def main():
-    service = get_gmail_service()
+def analyze_emails(emails):
+    """
+    Classifies several (subject, sender, body) emails with one Ollama request, using structured
+    JSON output that maps an ID per email to its label. The IDs are the positions 1..K rather than
+    Gmail's message IDs, short numbers are much harder for the model to garble.
+    Returns one label per email, None where the model left an email out or gave an invalid label.
+    """
+    if len(emails) == 1:
+        return [analyze_email(*emails[0])]
+
+    email_ids = [str(i + 1) for i in range(len(emails))]
+    prompt = BATCH_PROMPT.format(emails="".join(
+        BATCH_EMAIL.format(email_id=email_id, sender=sender, subject=subject, body=body[:BODY_CHARS])
+        for email_id, (subject, sender, body) in zip(email_ids, emails)))
+    # JSON schema that makes Ollama answer with exactly one valid label per ID
+    schema = {
+        'type': 'object',
+        'properties': {email_id: {'type': 'string', 'enum': VALID_LABELS} for email_id in email_ids},
+        'required': email_ids,
+    }
 
-    # ask user for input on number of emails to iterate
     try:
-        if len(sys.argv) > 1:
-            max_count = int(sys.argv[1])
-        else:
-            max_count = 10  # Default if run manually without a number
-    except ValueError:
-        max_count = 10
+        response = ollama.chat(model=SORTER_MODEL, messages=[
+            {'role': 'user', 'content': prompt},
+        ], format=schema)
+        answers = json.loads(response['message']['content'])
+    except Exception as e:
+        print(f"Ollama Error: {e}")
+        return [None] * len(emails)
 
-    # defining counter variables
-    deleted_counter = 0
-    saved_counter = 0
-    not_sure_counter = 0
+    if not isinstance(answers, dict):
+        return [None] * len(emails)
+    return [answers.get(email_id) if answers.get(email_id) in VALID_LABELS else None for email_id in email_ids]
 
-    # Ensure labels exist and get their IDs
-    label_map = {
-        'ec_delete': get_or_create_label_id(service, 'ec_delete'),
-        'ec_save': get_or_create_label_id(service, 'ec_save'),
-        'ec_not_sure': get_or_create_label_id(service, 'ec_not_sure')
-    }
 
-    print("Checking for unread emails...")
+def triage(meta, rules, cache):
+    """
+    Tries to label an email from its metadata (headers and snippet) only, first with the
+    header rules and then with the classification cache.
+    Returns (label, tier) or None when the email has to go to the LLM.
+    """
+    if rules is not None:
+        decision = rules.classify(meta['payload']['headers'])
+        if decision is not None:
+            return decision, 'rules'
+    if cache is not None:
+        subject, sender = get_subject_and_sender(meta)
+        decision = cache.get(sender, subject, meta.get('snippet', ''))
+        if decision is not None:
+            return decision, 'cache'
+    return None
+
+
+class StageStats:
+    """
+    Counts the emails a pipeline stage handled and the time window it was active in.
+    """
 
-    # Get unread messages (max 10 to prevent rate limits during testing)
-    results = service.users().messages().list(userId='me', q='is:unread', maxResults=max_count).execute()
-    messages = results.get('messages', [])
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.busy = 0.0
+        self.first = None
+        self.last = None
+        self.lock = threading.Lock()
 
-    if not messages:
-        print("No unread messages found.")
-        return
+    def record(self, started, count=1):
+        finished = time.perf_counter()
+        with self.lock:
+            self.count += count
+            self.busy += finished - started
+            self.first = started if self.first is None else min(self.first, started)
+            self.last = finished if self.last is None else max(self.last, finished)
 
-    for msg in messages:
-        msg_detail = service.users().messages().get(userId='me', id=msg['id']).execute()
-        headers = msg_detail['payload']['headers']
+    def rate(self):
+        if not self.count:
+            return 0.0
+        return self.count / max(self.last - self.first, 1e-9)
 
-        subject = next((h['value'] for h in headers if h['name'] == 'Subject'), "No Subject")
-        sender = next((h['value'] for h in headers if h['name'] == 'From'), "Unknown Sender")
-        snippet = msg_detail.get('snippet', '')
+    def __str__(self):
+        return f"{self.name}: {self.count} emails, {self.rate():.1f} emails/sec ({self.busy:.1f}s busy)"
 
-        # Get full body content (or fallback to snippet)
-        full_body = get_email_content(msg_detail['payload']) or snippet
 
-        #print(f"\nProcessing: {subject[:50]}...")
+def put(q, item, stop):
+    """
+    Blocking put that gives up once the pipeline is stopped, so no stage hangs on a full queue.
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return
+        except queue.Full:
+            continue
 
-        # Ask Local LLM
-        decision_label_name = analyze_email(subject, sender, full_body)
-        decision_label_id = label_map[decision_label_name]
 
-        #print(f" -> Decision: {decision_label_name}")
-        if decision_label_name =="ec_delete":
-            deleted_counter+=1
-        elif decision_label_name =="ec_save":
-            saved_counter+=1
-        else:
-            not_sure_counter+=1
+def take(q, stop):
+    """
+    Blocking get that returns DONE once the pipeline is stopped.
+    """
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.5)
+        except queue.Empty:
+            continue
+    return DONE
 
 
+def get_subject_and_sender(msg_detail):
+    headers = msg_detail['payload']['headers']
 
-        # Apply new label
-        service.users().messages().batchModify(
-            userId='me',
-            body={
-                'ids': [msg['id']],
-                'addLabelIds': [decision_label_id]
-            }
-        ).execute()
+    subject = next((h['value'] for h in headers if h['name'] == 'Subject'), "No Subject")
+    sender = next((h['value'] for h in headers if h['name'] == 'From'), "Unknown Sender")
+    return subject, sender
 
 
+def run_pipeline(fetch_service, label_buffer, msg_ids, cache=None, rules=None, workers=OLLAMA_WORKERS,
+                 batch_size=CLASSIFY_BATCH_SIZE, queue_size=PIPELINE_QUEUE_SIZE):
+    """
+    Sorts emails with a staged pipeline: fetch -> extract body -> classify -> label.
+    Fetching happens in two phases. Phase one only downloads headers and snippets, which is enough
+    for the header rules and the cache. Emails they can decide go straight to label, and only
+    the rest have their full body downloaded in phase two and are sent to Ollama, up to batch_size
+    emails per request.
+    Fetch, extract and each classify worker run on their own thread and label runs on the calling thread.
+    The bounded queues between them let Gmail requests overlap with Ollama generation, and a full queue
+    blocks the stage in front of it (backpressure) so memory stays flat however many emails are sorted.
+    fetch_service must not be the service used by label_buffer, googleapiclient services aren't thread safe.
+    Returns the number of emails per label, the number of emails each tier decided, the stats of every stage
+    and how many of msg_ids were dealt with (labeled now or by an earlier run). Emails that failed to fetch
+    or read aren't counted.
+    """
+    fetched = queue.Queue(queue_size)
+    extracted = queue.Queue(queue_size)
+    classified = queue.Queue(queue_size)
+    stop = threading.Event()
+    stats = {name: StageStats(name) for name in ('fetch', 'fetch body', 'extract', 'classify', 'label')}
+    counts = {label_name: 0 for label_name in label_buffer.label_map}
+    # Label IDs of our own labels, used to skip emails an earlier run already labeled
+    sorted_label_ids = set(label_buffer.label_map.values())
+    tiers = {'rules': 0, 'cache': 0, 'llm': 0}
+    already_sorted = 0
+
+    # Phase one only needs the headers the rules and the cache look at
+    metadata_headers = ['From', 'Subject'] + (rules.header_names if rules else [])
+
+    def fetch_stage():
+        nonlocal already_sorted
+        def fetch_bodies(needs_llm):
+            # Phase two: the full payload, only for the emails that go to the LLM
+            started = time.perf_counter()
+            for msg_id, msg_detail in fetch_messages(fetch_service, list(needs_llm), fields=FULL_FIELDS):
+                put(fetched, (msg_id, needs_llm[msg_id], msg_detail), stop)
+            stats['fetch body'].record(started, len(needs_llm))
+
+        try:
+            # One call for all of phase one, so its rate-limited items are retried together at the end.
+            # The bodies are fetched every BATCH_SIZE emails, so the LLM doesn't wait for the whole list.
+            started = time.perf_counter()
+            count = 0
+            needs_llm = {}
+            for msg_id, meta in fetch_messages(fetch_service, msg_ids, format='metadata',
+                                               metadataHeaders=metadata_headers, fields=METADATA_FIELDS):
+                count += 1
+                # Already labeled by an earlier run
+                if sorted_label_ids & set(meta.get('labelIds', [])):
+                    already_sorted += 1
+                else:
+                    decision = triage(meta, rules, cache)
+                    if decision is None:
+                        needs_llm[msg_id] = meta
+                    else:
+                        put(classified, (msg_id, *decision), stop)
+                if count % BATCH_SIZE == 0:
+                    stats['fetch'].record(started, BATCH_SIZE)
+                    fetch_bodies(needs_llm)
+                    needs_llm = {}
+                    started = time.perf_counter()
+            if count % BATCH_SIZE:
+                stats['fetch'].record(started, count % BATCH_SIZE)
+            if needs_llm:
+                fetch_bodies(needs_llm)
+        except Exception as e:
+            print(f"Fetch Error: {e}")
+        finally:
+            put(fetched, DONE, stop)
+
+    def extract_stage():
+        while True:
+            item = take(fetched, stop)
+            if item is DONE:
+                break
+            started = time.perf_counter()
+            msg_id, meta, msg_detail = item
+            try:
+                subject, sender = get_subject_and_sender(meta)
+                snippet = meta.get('snippet', '')
+                # Get full body content (or fallback to snippet)
+                body = get_email_content(msg_detail['payload']) or snippet
+            except Exception as e:
+                print(f"Error reading message {msg_id}: {e}")
+                continue
+            stats['extract'].record(started)
+            put(extracted, (msg_id, subject, sender, snippet, body), stop)
+        put(extracted, DONE, stop)
+
+    def classify_stage():
+        finished = False
+        while not finished:
+            item = take(extracted, stop)
+            if item is DONE:
+                # Hand the marker on to the other workers before finishing
+                put(extracted, DONE, stop)
+                break
+            # Add whatever else is already waiting, up to batch_size, without waiting for more
+            batch = [item]
+            while len(batch) < batch_size:
+                try:
+                    item = extracted.get_nowait()
+                except queue.Empty:
+                    break
+                if item is DONE:
+                    put(extracted, DONE, stop)
+                    finished = True
+                    break
+                batch.append(item)
+
+            started = time.perf_counter()
+            decisions = analyze_emails([(subject, sender, body) for _, subject, sender, _, body in batch])
+            for (msg_id, subject, sender, snippet, body), decision_label_name in zip(batch, decisions):
+                if decision_label_name is None and len(batch) > 1:
+                    # Missing or invalid in the batched answer, ask again for this email on its own
+                    decision_label_name = analyze_email(subject, sender, body)
+                if decision_label_name is None:
+                    decision_label_name = 'ec_not_sure'
+                elif cache is not None:
+                    # Keyed on the snippet, so the next run can find it from the metadata alone
+                    cache.put(sender, subject, snippet, decision_label_name)
+                put(classified, (msg_id, decision_label_name, 'llm'), stop)
+            stats['classify'].record(started, len(batch))
+        put(classified, DONE, stop)
+
+    threads = [threading.Thread(target=fetch_stage, daemon=True),
+               threading.Thread(target=extract_stage, daemon=True)]
+    threads += [threading.Thread(target=classify_stage, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        remaining = workers
+        while remaining:
+            item = take(classified, stop)
+            if item is DONE:
+                remaining -= 1
+                continue
+            started = time.perf_counter()
+            msg_id, decision_label_name, tier = item
+            label_buffer.add(msg_id, decision_label_name)
+            counts[decision_label_name] += 1
+            tiers[tier] += 1
+            stats['label'].record(started)
+    finally:
+        # Unblocks any stage still waiting on a full queue if labeling failed
+        stop.set()
+
+    # fetch_stage is done counting before its DONE marker reaches the label loop
+    return counts, tiers, stats, sum(counts.values()) + already_sorted
+
+
+def sort_emails(max_count, sync=False):
+    """
+    Sorts up to max_count unread emails and returns the summary text.
+    With sync, only the emails that arrived since the last sync run are sorted.
+    Runs in-process (the bot calls it on a worker thread), runs must not overlap.
+    """
+    global _label_map
+    # One service for labeling and one for the fetch thread, googleapiclient services aren't thread safe
+    with gmail_service() as service, gmail_service() as fetch_service:
+        # Ensure labels exist and get their IDs
+        label_map = get_label_map(service)
+
+        print("Checking for unread emails...")
+
+        msg_ids, latest_history_id = list_messages(service, max_count, sync)
+
+        if not msg_ids:
+            if latest_history_id:
+                save_sync_state({'history_id': latest_history_id})
+            print("No unread messages found.")
+            return "No unread messages found."
+
+        # Label decisions are buffered and written in bulk, the finally block flushes whatever is left
+        # so an error halfway through only loses the decisions that were never made.
+        label_buffer = LabelWriteBuffer(service, label_map)
+        cache = ClassificationCache(version=CACHE_VERSION, max_entries=CACHE_MAX_ENTRIES,
+                                    ttl=CACHE_TTL_DAYS * 24 * 3600, sender_verdicts=CACHE_SENDER_VERDICTS)
+        started = time.perf_counter()
+        try:
+            counts, tiers, stats, processed = run_pipeline(fetch_service, label_buffer, msg_ids, cache, HeaderClassifier())
+        finally:
+            cache.close()
+            try:
+                label_buffer.flush()
+            except HttpError as e:
+                # A label deleted in Gmail while the bot was running, look them up again next time
+                if getattr(e.resp, 'status', None) in (400, 404):
+                    _label_map = None
+                raise
+        # Only move the sync position once every label has been written, and only if no email was lost
+        # to a fetch or read error on the way, or later sync runs would never see it again
+        if latest_history_id and processed == len(msg_ids):
+            save_sync_state({'history_id': latest_history_id})
+        elif latest_history_id:
+            print(f"{len(msg_ids) - processed} emails couldn't be sorted, the sync position stays for the next run.")
+        elapsed = time.perf_counter() - started
+
+    for stage in stats.values():
+        print(stage)
+
     # Final summary (this will print to your terminal)
-    summary = (f"Successfully sorted {len(messages)} emails:\n"
-               f"🗑 Deleted: {deleted_counter}\n"
-               f"💾 Saved: {saved_counter}\n"
-               f"❓ Not sure: {not_sure_counter}")
+    sorted_count = sum(counts.values())
+    summary = (f"Successfully sorted {sorted_count} emails:\n"
+               f"🗑 Deleted: {counts['ec_delete']}\n"
+               f"💾 Saved: {counts['ec_save']}\n"
+               f"❓ Not sure: {counts['ec_not_sure']}\n"
+               f"🧩 Decided by rules: {tiers['rules']}, cache: {tiers['cache']}, LLM: {tiers['llm']} "
+               f"({tiers['rules'] + tiers['cache']} LLM calls saved)\n"
+               f"⚡ Cache: {cache.hits} hits, {cache.misses} misses\n"
+               f"⏱ {elapsed:.1f}s ({sorted_count / max(elapsed, 1e-9):.1f} emails/sec)")
 
     print(summary)
+    return summary
+
+
+def main():
+    # ask user for input on number of emails to iterate
+    try:
+        if len(sys.argv) > 1:
+            max_count = int(sys.argv[1])
+        else:
+            max_count = 10  # Default if run manually without a number
+    except ValueError:
+        max_count = 10
+    # --sync only looks at mail that arrived since the last --sync run
+    sync = '--sync' in sys.argv[2:]
+
+    summary = sort_emails(max_count, sync)
 
     def send_telegram_update(text):
         token = os.getenv("TELEGRAM_TOKEN")
@@ -200,4 +844,4 @@ def main():
     send_telegram_update(summary)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import ollama
+
+from document_index import split_chunks
+
+# Ollama model used to embed the files in analysis/ (pull it with `ollama pull nomic-embed-text`)
+EMBED_MODEL = os.getenv("EMBED_MODEL", "nomic-embed-text")
+# Folder with the saved index, kept next to analysis/ so it isn't indexed itself
+INDEX_DIR = "analysis_index"
+# How many file pieces go into one embedding request
+EMBED_BATCH_SIZE = 32
+# How many pieces /ask sends to the LLM with the question
+ASK_TOP_K = int(os.getenv("ASK_TOP_K", 5))
+# Files whose first bytes contain a NUL byte are treated as binary and skipped
+BINARY_CHECK_BYTES = 1024
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def is_text_file(path):
+    with open(path, "rb") as f:
+        return b"\0" not in f.read(BINARY_CHECK_BYTES)
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class EmbeddingIndex:
+    """
+    Semantic search over every text file in a folder. Vectors are kept in a memory-mapped .npy file
+    (one normalized row per file piece) with a metadata.json next to it that lists the files and pieces.
+    update() only embeds files whose size, modification time and content hash changed, search()
+    is one matrix-vector product over the memory-mapped rows.
+    """
+
+    def __init__(self, base_dir, index_dir=INDEX_DIR, model=EMBED_MODEL):
+        self.base_dir = str(base_dir)
+        self.index_dir = str(index_dir)
+        self.model = model
+        self.vectors_path = os.path.join(self.index_dir, "vectors.npy")
+        self.metadata_path = os.path.join(self.index_dir, "metadata.json")
+        # (vectors, chunks, files) are swapped in together, so a search never mixes two versions
+        self.state = (np.zeros((0, 0), dtype=np.float32), [], {})
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.metadata_path):
+            return
+        with open(self.metadata_path, "r") as f:
+            metadata = json.load(f)
+        if metadata.get("model") != self.model:
+            # Vectors of a different model can't be compared with new ones
+            return
+        chunks = metadata["chunks"]
+        if chunks:
+            vectors = np.load(self.vectors_path, mmap_mode="r")
+            if len(vectors) != len(chunks):
+                # Interrupted while saving, the next update() embeds everything again
+                return
+        else:
+            vectors = np.zeros((0, 0), dtype=np.float32)
+        self.state = (vectors, chunks, metadata["files"])
+
+    def __len__(self):
+        return len(self.state[1])
+
+    def embed(self, texts):
+        vectors = []
+        for i in range(0, len(texts), EMBED_BATCH_SIZE):
+            response = ollama.embed(model=self.model, input=texts[i:i + EMBED_BATCH_SIZE])
+            vectors.extend(response["embeddings"])
+        return normalize(vectors)
+
+    def scan(self):
+        # Relative path -> full path of every text file in the folder
+        found = {}
+        for root, dirs, names in os.walk(self.base_dir):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in names:
+                path = os.path.join(root, name)
+                if not name.startswith(".") and is_text_file(path):
+                    found[os.path.relpath(path, self.base_dir)] = path
+        return found
+
+    def update(self):
+        """
+        Brings the index up to date with the folder. Returns a dict with what was done.
+        """
+        started = time.perf_counter()
+        old_vectors, old_chunks, old_files = self.state
+        files = {}
+        changed = []
+        for relpath, path in sorted(self.scan().items()):
+            stat = os.stat(path)
+            old = old_files.get(relpath)
+            if old and old["size"] == stat.st_size and old["mtime"] == stat.st_mtime:
+                files[relpath] = old
+                continue
+            digest = file_hash(path)
+            if old and old["sha256"] == digest:
+                # Touched but not changed
+                files[relpath] = dict(old, mtime=stat.st_mtime)
+                continue
+            files[relpath] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": digest}
+            changed.append(relpath)
+        removed = [relpath for relpath in old_files if relpath not in files]
+
+        # Reuse the rows of unchanged files, embed the pieces of changed ones
+        changed_files = set(changed)
+        keep = [i for i, chunk in enumerate(old_chunks) if chunk["file"] in files and chunk["file"] not in changed_files]
+        chunks = [old_chunks[i] for i in keep]
+        new_texts = []
+        for relpath in changed:
+            with open(os.path.join(self.base_dir, relpath), "r", errors="replace") as f:
+                pieces = split_chunks(f.read())
+            chunks.extend({"file": relpath, "text": piece} for piece in pieces)
+            new_texts.extend(pieces)
+        new_vectors = self.embed(new_texts) if new_texts else None
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        if chunks:
+            dim = new_vectors.shape[1] if new_vectors is not None else old_vectors.shape[1]
+            tmp_path = self.vectors_path + ".tmp.npy"
+            vectors = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(chunks), dim))
+            if keep:
+                vectors[:len(keep)] = old_vectors[keep]
+            if new_vectors is not None:
+                vectors[len(keep):] = new_vectors
+            vectors.flush()
+            del vectors
+            os.replace(tmp_path, self.vectors_path)
+        with open(self.metadata_path + ".tmp", "w") as f:
+            json.dump({"model": self.model, "files": files, "chunks": chunks}, f)
+        os.replace(self.metadata_path + ".tmp", self.metadata_path)
+        self.load()
+        return {"files": len(files), "changed": len(changed), "removed": len(removed), "chunks": len(chunks),
+                "embedded": len(new_texts), "seconds": time.perf_counter() - started}
+
+    def search(self, query_vector, k=ASK_TOP_K):
+        """
+        The k pieces most similar to the query vector, best first, as (score, file, text).
+        """
+        vectors, chunks, _ = self.state
+        if not chunks:
+            return []
+        scores = vectors @ normalize([query_vector])[0]
+        k = min(k, len(chunks))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[i]), chunks[i]["file"], chunks[i]["text"]) for i in best]
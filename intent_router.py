@@ -0,0 +1,53 @@
+import re
+
+PERIOD = r"(?: (?:for |on )?(?P<period>today|tonight|tomorrow|this week))?"
+
+# (intent, pattern) in the order they are tried. The patterns have to match the whole message,
+# so anything that is more than a plain reminder question still goes to the LLM.
+RULES = [
+    ('next_reminder', r"(?:what(?:'s| is)|when(?:'s| is)) (?:my |the )?next reminder"),
+    ('next_reminder', r"(?:my |the )?next reminder"),
+    ('cancel_next_reminder', r"(?:cancel|delete|remove) (?:my |the )?next reminder"),
+    ('cancel_reminder', r"(?:cancel|delete|remove) (?:my |the )?reminder (?:to |about |for |called )?(?P<task>.+)"),
+    ('list_reminders', r"(?:what|which) (?:are |is )?(?:my |the )?reminders?(?: (?:do i have|have i set|are set|i have))?" + PERIOD),
+    ('list_reminders', r"(?:list|show)(?: me)?(?: all)? (?:of )?(?:my |the )?reminders" + PERIOD),
+    ('list_reminders', r"(?:do i have|are there) any reminders(?: set)?" + PERIOD),
+    ('list_reminders', r"(?:my |all )?reminders" + PERIOD),
+]
+
+# Removed before matching, they don't change what is asked
+FILLER = re.compile(r"^(?:hey |hi |ok |okay )?(?:please |can you |could you )?|(?: please)?[\s?!.]*$")
+
+
+def normalize(text):
+    text = " ".join(text.lower().replace("’", "'").split())
+    return FILLER.sub("", text)
+
+
+class IntentRouter:
+    """
+    Recognizes reminder questions with regex rules so they can be answered straight from the reminder
+    store. route() returns (intent, params) or None for messages that should go to the LLM,
+    and counts both for /stats.
+    """
+
+    def __init__(self, rules=RULES):
+        self.rules = [(intent, re.compile(pattern)) for intent, pattern in rules]
+        self.hits = {}
+        self.misses = 0
+
+    def route(self, text):
+        text = normalize(text)
+        for intent, pattern in self.rules:
+            match = pattern.fullmatch(text)
+            if match:
+                self.hits[intent] = self.hits.get(intent, 0) + 1
+                return intent, {k: v for k, v in match.groupdict().items() if v}
+        self.misses += 1
+        return None
+
+    def stats(self):
+        routed = sum(self.hits.values())
+        total = routed + self.misses
+        return {'messages': total, 'answered_directly': routed, 'sent_to_llm': self.misses,
+                'hit_rate': routed / total if total else 0.0, 'intents': dict(self.hits)}
@@ -0,0 +1,45 @@
+import asyncio
+
+
+class LLMQueue:
+    """
+    Every Ollama call of the bot goes through this queue. At most `concurrency` calls run at once,
+    and at most `max_waiting` more can wait for a turn. submit() raises asyncio.QueueFull when
+    the queue is full, so a burst of messages can't pile up unbounded work behind a slow model.
+    """
+
+    def __init__(self, concurrency, max_waiting):
+        self.concurrency = concurrency
+        self.queue = asyncio.Queue(maxsize=max_waiting)
+        self.workers = []
+        self.completed = 0
+
+    def start(self):
+        # Needs a running event loop, so it is done on the first submit
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(self.concurrency)]
+
+    async def worker(self):
+        while True:
+            job, future = await self.queue.get()
+            try:
+                if not future.cancelled():
+                    future.set_result(await job())
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self.completed += 1
+                self.queue.task_done()
+
+    async def submit(self, job):
+        """
+        Queues `job`, a function returning a coroutine, and waits for its result.
+        """
+        if not self.workers:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((job, future))
+        return await future
+
+    def waiting(self):
+        return self.queue.qsize()
@@ -1,16 +1,30 @@
-import telebot
+import asyncio
+from telebot.async_telebot import AsyncTeleBot
 import ollama
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.jobstores.base import JobLookupError
 from datetime import datetime, timedelta
 import re
-import json
 import os
 import uuid
-import subprocess
 import shlex
+import time
 from pathlib import Path
+from urllib.parse import urlparse
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+import email_sorter
+from reminder_store import ReminderStore, TIME_FORMAT
+from chat_session import SessionStore, get_estimator, CONTEXT_TOKEN_BUDGET
+from llm_queue import LLMQueue
+from document_index import DocumentIndex
+from embedding_index import EmbeddingIndex, EMBED_MODEL, INDEX_DIR
+from model_manager import ModelManager
+from intent_router import IntentRouter
+from telegram_dispatcher import OutboundDispatcher, MESSAGE_LIMIT, split_message, utf16_len
+from webhook_server import WebhookServer, WEBHOOK_URL, WEBHOOK_SECRET
+from ssh_channel import SSHChannel
 
 # telergram bot token and telegram user id from .env file
 load_dotenv()
@@ -20,86 +34,156 @@ your_name = os.getenv("YOUR_NAME")
 bot_name = os.getenv("BOT_NAME")
 model = os.getenv("MODEL_NAME")
 
-bot = telebot.TeleBot(TOKEN)
-# json file storing all reminders
+# Handlers are coroutines on one event loop, so waiting on Ollama, SSH or a file doesn't block other messages
+bot = AsyncTeleBot(TOKEN)
+# Every message goes out through this queue, it keeps to Telegram's rate limits so handlers don't have to wait
+outbox = OutboundDispatcher(bot)
+ollama_client = ollama.AsyncClient()
+# Cached model list, loading and unloading of the chat model
+models = ModelManager(ollama_client)
+# old json file storing all reminders, imported into the reminder store once
 REMINDERS_FILE = "reminders.json"
+reminder_store = ReminderStore(legacy_json=REMINDERS_FILE)
+# Only reminders due within this many hours are added to the chat prompt, at most REMINDER_CONTEXT_LIMIT of them
+REMINDER_WINDOW_HOURS = int(os.getenv("REMINDER_WINDOW_HOURS", 48))
+REMINDER_CONTEXT_LIMIT = int(os.getenv("REMINDER_CONTEXT_LIMIT", 10))
+# Reminder questions are answered straight from the reminder store, without the LLM
+router = IntentRouter()
+# Most reminders listed in such an answer
+REMINDER_LIST_LIMIT = 20
+# Post the reply while Ollama is still writing it and edit the message as more text comes in.
+# Telegram rate limits edits, so the message is edited at most once every STREAM_EDIT_INTERVAL seconds.
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.0))
+# How many chat replies Ollama generates at the same time, and how many more messages can wait for a turn
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 1))
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", 20))
+llm_queue = LLMQueue(LLM_CONCURRENCY, LLM_QUEUE_SIZE)
+# Characters of each message that go into the history summary
+SUMMARY_MESSAGE_CHARS = 2000
+# Totals of the prompt sizes and of what Ollama actually had to evaluate
+prompt_stats = {'turns': 0, 'prompt_tokens': 0, 'evaluated_tokens': 0, 'eval_seconds': 0.0}
 # path that the LLM has access to in order to read files (analysis dir).
 BASE_DIR = Path(os.getcwd()).joinpath("analysis").resolve()
+# Embeddings of everything in the analysis dir for /ask, loaded from disk and updated with /reindex
+analysis_index = EmbeddingIndex(BASE_DIR, Path(os.getcwd()).joinpath(INDEX_DIR))
+reindex_lock = asyncio.Lock()
 
-# Initialize the scheduler
-scheduler = BackgroundScheduler()
-scheduler.start()
+# SSH connection to the torrent server, opened with the first /torrent and kept open
+ssh_channel = SSHChannel(os.getenv("SSH_TARGET"))
 
-# This list will store the conversation history
-# We start it with a 'system' message to define bot's personality
-chat_history = [
-    {
-        'role': 'system',
-        'content': f"""
+# Initialize the scheduler, it is started once the event loop runs
+scheduler = AsyncIOScheduler()
+
+# The email sorter runs in-process on this thread so its Gmail connection stays warm between runs.
+# One worker means a second /clean_emails waits for the first one instead of running alongside it.
+sorter_executor = ThreadPoolExecutor(max_workers=1)
+# /clean_emails runs that are sorting or waiting for their turn
+sort_runs = 0
+
+# Every chat gets its own conversation history
+# Each one starts with a 'system' message to define bot's personality
+sessions = SessionStore(f"""
             Your name is {bot_name}, you are {your_name}'s virtual assistant. 
             {your_name} knows who you are. 
             Try to answer all questions directly in no more than 4-5 sentences.
             If I ask about my reminders, list them in bullet points.
-        """
-    }
-]
-
+        """)
 
-def load_reminders():
-    if os.path.exists(REMINDERS_FILE):
-        with open(REMINDERS_FILE, "r") as f:
-            return json.load(f)
-    return []
+# Keeps a reference to background tasks (like /torrent) so they aren't garbage collected while running
+background_tasks = set()
 
 
-def save_reminders(reminders):
-    with open(REMINDERS_FILE, "w") as f:
-        json.dump(reminders, f, indent=4)
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
 
 
-def check_user(message):
+async def check_user(message):
     # Check to make sure that only the person with the right user ID can speak with TARS.
     if message.from_user.id != ALLOWED_USER_ID:
-        bot.reply_to(message, f"Access denied. I only talk to {your_name}. ✋")
+        outbox.reply(message, f"Access denied. I only talk to {your_name}. ✋")
         return False
     else:
         return True
 
 
-def send_long_message(chat_id, text):
-    # Telegram has limits on how long a message can be.
-    # This function split up replies and send them as multiple messages.
-    for i in range(0, len(text), 4000):
-        bot.send_message(chat_id, text[i:i + 4000])
-
-
-def get_installed_models():
+async def stream_reply(chat_id, chunks):
+    """
+    Shows a streamed Ollama reply in Telegram as it is generated. The first message is sent as soon as
+    there is text, then edited at most every STREAM_EDIT_INTERVAL seconds, and a new message is started
+    when it reaches MESSAGE_LIMIT. Returns the full reply, the seconds until the first text was visible
+    and Ollama's last chunk, which has the token counts.
+    """
+    started = time.perf_counter()
+    first_visible = None
+    reply = ""
+    current = ""  # text of the message being written
+    shown = ""  # what that message shows right now
+    message_id = None
+    last_edit = 0.0
+    final_chunk = None
+
+    async def show(text, final=False):
+        nonlocal message_id, shown, last_edit, first_visible
+        # Telegram trims whitespace and refuses empty messages or edits that change nothing
+        if not text.strip() or text.strip() == shown.strip():
+            return
+        if message_id is None:
+            # The message id is needed for the edits, so this one is waited for.
+            # It isn't merged with other messages, that would leave the edits pointing at the merged one.
+            message_id = (await outbox.send(chat_id, text, coalesce=False)).message_id
+        elif final:
+            await outbox.edit(chat_id, message_id, text)
+        else:
+            # Not waited for, edits that pile up in the outbox are merged into the newest one
+            outbox.edit(chat_id, message_id, text)
+        shown = text
+        last_edit = time.monotonic()
+        if first_visible is None:
+            first_visible = time.perf_counter() - started
+
+    async for chunk in chunks:
+        if chunk.get('done'):
+            final_chunk = chunk
+        piece = chunk['message']['content']
+        reply += piece
+        current += piece
+        # Finish the message at the length limit and continue in a new one
+        while utf16_len(current) > MESSAGE_LIMIT:
+            full = split_message(current)[0]
+            await show(full, final=True)
+            current = current[len(full):]
+            message_id, shown = None, ""
+        if message_id is None or time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+            await show(current)
+    await show(current, final=True)
+    return reply, first_visible, final_chunk
+
+
+async def get_installed_models():
     try:
-        models_data = ollama.list()
-        # In the latest library, 'models' is an attribute, and each model has a '.model' property
-        return [m.model for m in models_data.models]
+        return await models.installed()
     except Exception as e:
-        # If the above fails, try the dictionary method as a fallback
-        try:
-            return [m['name'] for m in ollama.list()['models']]
-        except:
-            print(f"Error fetching models: {e}")
-            return []
+        print(f"Error fetching models: {e}")
+        return []
 
 
 @bot.message_handler(commands=['id'])
-def get_my_id(message):
+async def get_my_id(message):
     # This is to get userID for intial setup
-    bot.reply_to(message, f"Your User ID is: {message.from_user.id}")
+    outbox.reply(message, f"Your User ID is: {message.from_user.id}")
 
 
 @bot.message_handler(commands=['model'])
-def change_model(message):
+async def change_model(message):
     # command to remove the LLM's chat history.
-    if not check_user(message):
+    if not await check_user(message):
         return
     global model
-    installed_models = get_installed_models()
+    installed_models = await get_installed_models()
     parts = message.text.split(maxsplit=1)
 
     if len(parts) < 2:
@@ -112,32 +196,54 @@ def change_model(message):
             "Example:\n"
             "/model gemma3:4b\n"
         )
-        bot.reply_to(message, response, parse_mode='HTML')
+        outbox.reply(message, response, parse_mode='HTML')
         return
 
     new_model = parts[1].strip()
     # Check if the requested model actually exists
-    if new_model in installed_models:
-        model = new_model
-        bot.reply_to(message, f"✅ Model switched to: <code>{model}</code>", parse_mode='HTML')
+    if new_model in installed_models or await models.is_installed(new_model):
+        old_model, model = model, new_model
+        outbox.reply(message, f"✅ Model switched to: <code>{model}</code>, loading it now...", parse_mode='HTML')
+        # Load it right away, so the next message doesn't have to wait for it
+        run_in_background(switch_model_job(message.chat.id, old_model, new_model))
     else:
-        bot.reply_to(message, f"❌ Error: <code>{new_model}</code> is not installed.\n"
+        outbox.reply(message, f"❌ Error: <code>{new_model}</code> is not installed.\n"
                               f"Use /model to see the list of available models.", parse_mode='HTML')
 
 
+async def switch_model_job(chat_id, old_model, new_model):
+    try:
+        # The /ask model is left loaded, and the email sorter's while a run is using it.
+        # Otherwise the sorter loads its model again when it needs it.
+        keep_loaded = {EMBED_MODEL} | ({email_sorter.SORTER_MODEL} if sort_runs else set())
+        seconds = await models.switch(old_model, new_model, keep_loaded=keep_loaded)
+        outbox.send(chat_id, f"🔥 {new_model} is ready (loaded in {seconds:.1f}s).")
+    except Exception as e:
+        outbox.send(chat_id, f"⚠️ Error loading {new_model}: {e}")
+
+
+async def warm_model():
+    # Loads the chat model at startup, so the first message doesn't wait for it
+    try:
+        await models.warm(model)
+    except Exception as e:
+        print(f"Error loading {model}: {e}")
+
+
 @bot.message_handler(commands=['reset'])
-def reset_history(message):
+async def reset_history(message):
     # command to remove the LLM's chat history.
-    if not check_user(message):
+    if not await check_user(message):
         return
-    global chat_history
-    chat_history = [chat_history[0]]  # Keep only the system prompt
-    bot.reply_to(message, "Memory wiped! I'm ready for a fresh start.")
+    session = sessions.get(message.chat.id)
+    async with session.lock:
+        session.reset()
+    outbox.reply(message, "Memory wiped! I'm ready for a fresh start.")
 
 
 @bot.message_handler(commands=['read'])
-def read(message):
-    if not check_user(message):
+async def read(message):
+    if not await check_user(message):
         return
     # Splits '/read filename' and takes everything after the space
     filename = message.text.split(maxsplit=1)[1]
@@ -146,113 +252,164 @@ def read(message):
 
     # SECURITY CHECK: Is the resulting path still inside the analysis folder?
     if not path.is_relative_to(BASE_DIR):
-        bot.reply_to(message, f"🛑Access Denied: Attempted to escape the analysis directory.")
+        outbox.reply(message, f"🛑Access Denied: Attempted to escape the analysis directory.")
         return
 
     try:
         if not os.path.exists(path):
-            bot.reply_to(message, f"❌ File not found at: {path}")
+            outbox.reply(message, f"❌ File not found at: {path}")
             return
-        with open(path, "r") as file:
-            content = file.read()
-        # Update the global chat history with the file content as a System instruction
-        global chat_history
-        filename = os.path.basename(path)
-        chat_history.append({
-            'role': 'system',
-            'content': f"Here is the content of that file:\n\n{content}\n\n"
-                       "Please use this information to answer any specific questions about the file."
-        })
-        bot.reply_to(message, f"📖 **{filename}** has been loaded into my memory. What would you like to know about it?")
+        # Read and index on a worker thread, a big file shouldn't stall the other chats.
+        # Only the parts of the file that match a question are sent to the LLM with it.
+        document = await asyncio.to_thread(DocumentIndex.from_file, path)
+        filename = document.name
+        session = sessions.get(message.chat.id)
+        async with session.lock:
+            session.document = document
+        outbox.reply(message, f"📖 **{filename}** has been loaded into my memory. What would you like to know about it?")
     except Exception as e:
-        bot.reply_to(message, f"❌ Error reading file: {e}")
+        outbox.reply(message, f"❌ Error reading file: {e}")
 
 
-@bot.message_handler(commands=['torrent'])
-def handle_torrent(message):
-    if not check_user(message):
+@bot.message_handler(commands=['ask'])
+async def ask(message):
+    if not await check_user(message):
         return
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        outbox.reply(message, "Please ask a question: `/ask what did the report say about sales?`",
+                     parse_mode='Markdown')
+        return
+    if not len(analysis_index):
+        outbox.reply(message, "🗂 Nothing is indexed yet, use /reindex first.")
+        return
+    question = parts[1]
 
-    # 2. Extract the magnet link
     try:
-        # Splits '/torrent <link>' and takes everything after the space
-        magnet_link = message.text.split(maxsplit=1)[1]
-    except IndexError:
-        bot.reply_to(message, "❌ Please provide a magnet link.\nUsage: `/torrent magnet:?xt=...`",
-                     parse_mode='Markdown')
+        vector = await llm_queue.submit(lambda: embed_question(question))
+    except asyncio.QueueFull:
+        outbox.reply(message, "⏳ I'm busy with other messages, please try again in a moment.")
+        return
+    except Exception as e:
+        outbox.reply(message, f"⚠️ Embedding Error: {str(e)}")
+        return
+    results = analysis_index.search(vector)
+    extra = [{'role': 'system',
+              'content': "Here are the parts of the files in the analysis folder that match the next question:\n\n"
+                         + "\n\n---\n\n".join(f"[{file}]\n{text}" for _, file, text in results)
+                         + "\n\nPlease use this information to answer the question and say which files it came from."}]
+
+    session = sessions.get(message.chat.id)
+    async with session.lock:
+        await answer(message, session, question, extra)
+
+
+async def embed_question(question):
+    response = await ollama_client.embed(model=EMBED_MODEL, input=question)
+    return response['embeddings'][0]
+
+
+@bot.message_handler(commands=['reindex'])
+async def reindex(message):
+    if not await check_user(message):
+        return
+    outbox.reply(message, "🗂 Indexing the analysis folder...")
+    # Embedding many files takes a while, chat keeps working in the meantime
+    run_in_background(reindex_job(message.chat.id))
+
+
+async def reindex_job(chat_id):
+    async with reindex_lock:
+        try:
+            result = await asyncio.to_thread(analysis_index.update)
+            outbox.send(chat_id, f"✅ Indexed {result['files']} files ({result['changed']} new or changed, "
+                                 f"{result['removed']} removed), {result['chunks']} pieces "
+                                 f"in {result['seconds']:.1f}s.")
+        except Exception as e:
+            outbox.send(chat_id, f"❌ Indexing error: {e}")
+
+
+@bot.message_handler(commands=['torrent'])
+async def handle_torrent(message):
+    if not await check_user(message):
         return
 
-    bot.reply_to(message, "📡 Sending request to Server...")
+    # 2. Extract the magnet links, '/torrent <link> <link> ...' sends them all in one go
+    magnet_links = message.text.split()[1:]
+    if not magnet_links or not all(link.startswith("magnet:") for link in magnet_links):
+        outbox.reply(message, "❌ Please provide one or more magnet links.\n"
+                              "Usage: `/torrent magnet:?xt=... magnet:?xt=...`", parse_mode='Markdown')
+        return
+
+    outbox.reply(message, f"📡 Sending {len(magnet_links)} magnet link(s) to Server...")
+
+    # The SSH call runs as a background task, so chat keeps working while the server responds
+    run_in_background(send_torrent(message.chat.id, magnet_links))
 
-    # We wrap the magnet link in shlex.quote to handle special characters safely
-    safe_magnet = shlex.quote(magnet_link)
+
+async def send_torrent(chat_id, magnet_links):
+    # We wrap the magnet links in shlex.quote to handle special characters safely
+    safe_magnets = " ".join(shlex.quote(link) for link in magnet_links)
     torrent_path = os.getenv("TORRENT_PATH")
-    remote_command = f"nohup sudo /usr/bin/python3 {torrent_path} {safe_magnet} > /dev/null 2>&1 &"
+    # One remote call for all of them
+    remote_command = f"nohup sudo /usr/bin/python3 {torrent_path} {safe_magnets} > /dev/null 2>&1 &"
 
     # 4. Execute via SSH
     # *****************
     # This assumes your client is already set up to SSH into server without a password prompt
     # *****************
-    ssh_target = os.getenv("SSH_TARGET")
-
     try:
-        # Run the command and capture output
-        result = subprocess.run(
-            ["ssh", ssh_target, remote_command],
-            capture_output=True,
-            text=True,
-            timeout=15  # Adjust timeout if server is slow to respond
-        )
-
-        if result.returncode == 0:
-            bot.send_message(message.chat.id, f"✅ **Server received the request:**\n\n{result.stdout}",
-                             parse_mode='Markdown')
+        # Runs over the connection that stays open to the server, only the first /torrent waits for SSH to connect
+        # Adjust SSH_CONNECT_TIMEOUT if server is slow to respond
+        returncode, stdout, stderr = await ssh_channel.run(remote_command)
+        if returncode == 0:
+            outbox.send(chat_id, f"✅ **Server received the request:**\n\n{stdout}",
+                        parse_mode='Markdown')
         else:
-            bot.send_message(message.chat.id, f"⚠️ **Server Error:**\n{result.stderr}")
-
-    except subprocess.TimeoutExpired:
-        bot.send_message(message.chat.id, "⏳ Error: SSH connection to server timed out.")
+            outbox.send(chat_id, f"⚠️ **Server Error:**\n{stderr}")
+    except asyncio.TimeoutError:
+        outbox.send(chat_id, "⏳ Error: SSH connection to server timed out.")
     except Exception as e:
-        bot.send_message(message.chat.id, f"❌ System Error: {str(e)}")
+        outbox.send(chat_id, f"❌ System Error: {str(e)}")
 
 
 # --- Helper function to send the reminder ---
-def send_reminder_callback(chat_id, task_text, reminder_id):
-    bot.send_message(chat_id, f"⏰ **REMINDER:** {task_text}")
-    # 2. Remove from JSON
-    reminders = load_reminders()
-    # Keep only the reminders that DON'T match this ID
-    updated_reminders = [r for r in reminders if r.get('id') != reminder_id]
-    save_reminders(updated_reminders)
+async def send_reminder_callback(chat_id, task_text, reminder_id):
+    outbox.send(chat_id, f"⏰ **REMINDER:** {task_text}")
+    # 2. Remove from the reminder store
+    reminder_store.remove(reminder_id)
 
 
 @bot.message_handler(commands=['clear_reminders'])
-def clear_reminders(message):
-    if not check_user(message):
+async def clear_reminders(message):
+    if not await check_user(message):
         return
     # clears scheduled reminders
     scheduler.remove_all_jobs()
-    # saves an empty list for reminders
-    save_reminders([])
-    bot.reply_to(message, "Done! Your reminder list has been wiped clean. 🧹")
+    # deletes every stored reminder
+    reminder_store.clear()
+    outbox.reply(message, "Done! Your reminder list has been wiped clean. 🧹")
 
 
 @bot.message_handler(commands=['exit'])
-def exit(message):
+async def exit(message):
     # stops entire python script
-    if not check_user(message):
+    if not await check_user(message):
         return
-    bot.reply_to(message, "🔌 Shutting down...")
+    outbox.reply(message, "🔌 Shutting down...")
+    await outbox.drain()
     # 1. Stop the scheduler
     scheduler.shutdown()
-    # 2. Stop the bot's polling loop
-    bot.stop_polling()
+    sorter_executor.shutdown(wait=False, cancel_futures=True)
+    await ssh_channel.close()
+    # 2. Close the bot's connection to Telegram
+    await bot.close_session()
     sys.exit(0)  # This stops the entire Python process
 
 
 @bot.message_handler(commands=['clean_emails'])
-def run_email_sorter(message):
-    if not check_user(message):
+async def run_email_sorter(message):
+    if not await check_user(message):
         return
     # 2. Extract the number (e.g., "/clean_emails 20" becomes "20")
     try:
@@ -260,23 +417,44 @@ def run_email_sorter(message):
         num_emails = message.text.split()[1]
     except IndexError:
         # If you just type /clean_emails without a number
-        bot.reply_to(message, "Please provide a number: `/clean_emails 20`", parse_mode='Markdown')
+        outbox.reply(message, "Please provide a number: `/clean_emails 20`", parse_mode='Markdown')
         return
 
-    bot.reply_to(message, f"🧹 Cleaning {num_emails} emails...")
-    # 3. Run the script (this runs 'python email_sorter.py 20' in the background)
-    subprocess.Popen(['python', 'email_sorter.py', num_emails])
-    bot.send_message(message.chat.id, "✅ Script started! I'll keep chatting while it runs.")
+    # "/clean_emails 20 sync" only looks at mail that arrived since the last sync
+    sync = 'sync' in message.text.split()[2:]
+    try:
+        max_count = int(num_emails)
+    except ValueError:
+        outbox.reply(message, "Please provide a number: `/clean_emails 20`", parse_mode='Markdown')
+        return
+
+    outbox.reply(message, f"🧹 Cleaning {num_emails} emails...")
+    # 3. Run the sorter on its worker thread so the bot keeps responding
+    run_in_background(sort_emails_job(message.chat.id, max_count, sync))
+    outbox.send(message.chat.id, "✅ Script started! I'll keep chatting while it runs.")
+
+
+async def sort_emails_job(chat_id, max_count, sync):
+    global sort_runs
+    sort_runs += 1
+    try:
+        summary = await asyncio.get_running_loop().run_in_executor(
+            sorter_executor, email_sorter.sort_emails, max_count, sync)
+        outbox.send(chat_id, summary)
+    except Exception as e:
+        outbox.send(chat_id, f"❌ Email sorter error: {e}")
+    finally:
+        sort_runs -= 1
 
 
 @bot.message_handler(commands=['remind'])
-def set_reminder(message):
-    if not check_user(message):
+async def set_reminder(message):
+    if not await check_user(message):
         return
     try:
         match = re.match(r'/remind\s+(\d+)([mhd])\s+(.*)', message.text)
         if not match:
-            bot.reply_to(message, "Use: `/remind 10m buy milk`")
+            outbox.reply(message, "Use: `/remind 10m buy milk`")
             return
 
         amount, unit, task = int(match.group(1)), match.group(2), match.group(3)
@@ -285,112 +463,323 @@ def set_reminder(message):
         delta = {'m': 'minutes', 'h': 'hours', 'd': 'days'}[unit]
         run_time = datetime.now() + timedelta(**{delta: amount})
         reminder_id = str(uuid.uuid4())  # Generate a unique ID
-        # SAVE TO JSON
-        reminders = load_reminders()
-        reminders.append({
-            "id": reminder_id,
-            "chat_id": message.chat.id,
-            "task": task,
-            "due_time": run_time.strftime("%Y-%m-%d %H:%M:%S")
-        })
-        save_reminders(reminders)
+        # Save to the reminder store
+        reminder_store.add(reminder_id, message.chat.id, task, run_time)
         # Schedule the live timer
-        scheduler.add_job(send_reminder_callback, 'date', run_date=run_time, args=[message.chat.id, task, reminder_id])
-        bot.reply_to(message, f"✅ Saved! Reminder set for {run_time.strftime('%H:%M')}.")
+        scheduler.add_job(send_reminder_callback, 'date', run_date=run_time, args=[message.chat.id, task, reminder_id],
+                          id=reminder_id)
+        outbox.reply(message, f"✅ Saved! Reminder set for {run_time.strftime('%H:%M')}.")
     except Exception as e:
-        bot.reply_to(message, f"Error: {e}")
+        outbox.reply(message, f"Error: {e}")
 
 
 @bot.message_handler(commands=['help', 'start'])
-def send_help(message):
-    if not check_user(message):
+async def send_help(message):
+    if not await check_user(message):
         return
     help_text = (
         f"👋 <b>Hi! I'm {bot_name}, your AI Assistant.</b>\n\n"
         "<b>Commands:</b>\n"
         "/reset ➡️ Wipe chat history\n\n"
 
-        "/read file.txt ➡️ Read a file in the analysis directory.\n\n"
+        "/read file.txt ➡️ Read a file in the analysis directory.\n"
+        "/ask question ➡️ Search all files in the analysis directory to answer a question.\n"
+        "/reindex ➡️ Update the search index after adding or changing files.\n\n"
 
         "<b>How to torrent:</b>\n"
-        "/torrent {magnet link} ➡️ provide the magnet link for the file you would like to torrent.\n\n"
+        "/torrent {magnet link} ➡️ provide the magnet link for the file you would like to torrent. "
+        "Separate several links with spaces to send them all at once.\n\n"
 
         "<b>How to clean emails:</b>\n"
-        "/clean_emails 10 ➡️ this will sort through 10 emails, enter as many as you'd like.\n\n"
+        "/clean_emails 10 ➡️ this will sort through 10 emails, enter as many as you'd like.\n"
+        "/clean_emails 10 sync ➡️ only sort emails that arrived since the last sync.\n\n"
 
         "<b>How to set a reminder:</b>\n"
         "/remind 10m buy milk ➡️ Use m for minutes, h for hours, and d for days.\n"
-        "/clear_reminders ➡️ Clear the JSON file\n\n"
+        "Ask \"what are my reminders today?\", \"what's my next reminder?\" or \"cancel my reminder to buy milk\".\n"
+        "/clear_reminders ➡️ Clear all reminders\n\n"
 
         "<b>How to change the current model:</b>\n"
         f"Current Model: <b>{model}</b>\n"
         "/model ➡️ see all the models available.\n"
         "/model [name-name] ➡️ To change to a different model\n\n"
 
+        "/stats ➡️ See how many messages were answered without the LLM.\n\n"
+
         "/exit ➡️ Stop the bot and end the python script.\n\n"
 
         "Or simply type a message to chat with me!"
     )
-    bot.reply_to(message, help_text, parse_mode='HTML')
+    outbox.reply(message, help_text, parse_mode='HTML')
 
 
-@bot.message_handler(func=lambda message: True)
-def handle_message(message):
-    global chat_history
+@bot.message_handler(commands=['stats'])
+async def show_stats(message):
+    if not await check_user(message):
+        return
+    routed = router.stats()
+    lines = [f"📊 Messages: {routed['messages']}, answered without the LLM: {routed['answered_directly']} "
+             f"({routed['hit_rate']:.0%})"]
+    lines += [f"  • {intent}: {count}" for intent, count in sorted(routed['intents'].items())]
+    if prompt_stats['prompt_tokens']:
+        reused = 1 - prompt_stats['evaluated_tokens'] / prompt_stats['prompt_tokens']
+        lines.append(f"🧠 LLM replies: {prompt_stats['turns']}, prompt tokens reused from cache: ~{max(0.0, reused):.0%}")
+    lines.append(f"⏳ LLM queue: {llm_queue.completed} done, {llm_queue.waiting()} waiting")
+    sent = outbox.stats
+    lines.append(f"📨 Telegram: {sent['sent']} sent, {sent['edited']} edits, {sent['coalesced']} merged, "
+                 f"{sent['retries']} rate limit retries, {sent['failed']} failed")
+    outbox.reply(message, "\n".join(lines))
+
 
-    if not check_user(message):
+@bot.message_handler(func=lambda message: True)
+async def handle_message(message):
+    if not await check_user(message):
         return
 
+    # One message per chat at a time, so replies can't interleave in the history
+    session = sessions.get(message.chat.id)
+    async with session.lock:
+        # Reminder questions are looked up directly, everything else goes to the LLM
+        routed = router.route(message.text)
+        if routed is None:
+            await answer(message, session, message.text, file_context(session, message.text))
+            return
+        reply = answer_intent(*routed)
+        outbox.reply(message, reply)
+        # Kept in the history so the LLM knows about it in follow-up questions
+        session.add('user', message.text)
+        session.add('assistant', reply)
+
+
+def period_window(period, now):
+    # Start, end and name of the time span a reminder question asks about
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period in ('today', 'tonight'):
+        return now, today + timedelta(days=1), " today"
+    if period == 'tomorrow':
+        return today + timedelta(days=1), today + timedelta(days=2), " tomorrow"
+    if period == 'this week':
+        return now, today + timedelta(days=7 - now.weekday()), " this week"
+    return now, datetime.max, ""
+
+
+def format_reminder(r, now):
+    due = datetime.strptime(r['due_time'], TIME_FORMAT)
+    if due.date() == now.date():
+        when = due.strftime('%H:%M')
+    elif due.date() == (now + timedelta(days=1)).date():
+        when = due.strftime('tomorrow %H:%M')
+    else:
+        when = due.strftime('%a %d %b %H:%M')
+    return f"{r['task']} ({when})"
+
+
+def cancel_reminder(r):
+    reminder_store.remove(r['id'])
+    try:
+        scheduler.remove_job(r['id'])
+    except JobLookupError:
+        pass
+
+
+def answer_intent(intent, params):
+    now = datetime.now()
+    if intent == 'list_reminders':
+        start, end, name = period_window(params.get('period'), now)
+        reminders, _ = reminder_store.window(start, end, REMINDER_LIST_LIMIT)
+        if not reminders:
+            return f"You have no reminders{name}. 🎉"
+        reply = f"⏰ Your reminders{name}:\n" + "\n".join(f"• {format_reminder(r, now)}" for r in reminders)
+        more = reminder_store.count(start, end) - len(reminders)
+        if more > 0:
+            reply += f"\n…and {more} more."
+        return reply
+
+    upcoming, _ = reminder_store.window(now, datetime.max, 1)
+    if intent == 'next_reminder':
+        return f"⏰ Next up: {format_reminder(upcoming[0], now)}" if upcoming else "You have no reminders. 🎉"
+    if intent == 'cancel_next_reminder':
+        if not upcoming:
+            return "You have no reminders to cancel."
+        cancel_reminder(upcoming[0])
+        return f"🗑 Cancelled: {format_reminder(upcoming[0], now)}"
+
+    # cancel_reminder: find it by (part of) its text
+    task = params['task'].strip()
+    matches = [r for r in reminder_store.due_after(now) if task in r['task'].lower()]
+    if not matches:
+        return f"I couldn't find a reminder matching \"{task}\"."
+    if len(matches) > 1:
+        return "Which one? Several reminders match:\n" + "\n".join(f"• {format_reminder(r, now)}" for r in matches)
+    cancel_reminder(matches[0])
+    return f"🗑 Cancelled: {format_reminder(matches[0], now)}"
+
+
+async def answer(message, session, question, extra):
+    # extra: messages with file contents that go into this prompt only
+    # The prompt starts with the parts that stay the same between turns (persona, summary, earlier messages)
+    # and ends with the ones that change (time, reminders, file pieces, the question), so Ollama can reuse
+    # its cache for everything before them instead of evaluating the whole prompt again.
     # 1. Prepare dynamic context (Time and Reminders)
-    reminders = load_reminders()
-    current_time = datetime.now().strftime("%A, %B %d, %Y %H:%M")
+    # Only the upcoming reminders go into the prompt, so it doesn't grow with the number of reminders
+    now = datetime.now()
+    reminders, other_count = reminder_store.window(now, now + timedelta(hours=REMINDER_WINDOW_HOURS),
+                                                   REMINDER_CONTEXT_LIMIT)
+    current_time = now.strftime("%A, %B %d, %Y %H:%M")
     reminder_context = f"Current Time: {current_time}\n"
 
     if reminders:
-        reminder_context += "Active Reminders (list each one in bullet points if asked):\n" + "\n".join(
+        reminder_context += (f"Reminders in the next {REMINDER_WINDOW_HOURS} hours "
+                             "(list each one in bullet points if asked):\n") + "\n".join(
             [f"- {r['task']} at {r['due_time']}" for r in reminders])
     else:
-        reminder_context += "No active reminders."
+        reminder_context += f"No reminders in the next {REMINDER_WINDOW_HOURS} hours."
+    if other_count:
+        reminder_context += f"\n({other_count} other reminders are set but not listed here.)"
 
-    # 2. Add the User's question to history
-    # We wrap the user question with the current time/reminder context so TARS is always up to date
-    prompt_with_context = f"--- SYSTEM CONTEXT ---\n{reminder_context}\n----------------------\n{message.text}"
-    chat_history.append({'role': 'user', 'content': prompt_with_context})
+    # 2. Add the User's question to history as it was written, the context only goes into this turn's prompt
+    # so TARS is always up to date without changing the history
+    session.add('user', question)
+    context = [{'role': 'system', 'content': reminder_context}] + extra
 
-    bot.send_chat_action(message.chat.id, 'typing')
+    await bot.send_chat_action(message.chat.id, 'typing')
 
     try:
-        # 3. Call Ollama with the full history (which now includes the file if /read was used)
-        response = ollama.chat(
-            model=model,
-            messages=chat_history,
-        )
-
-        ai_reply = response['message']['content']
+        # 3. Call Ollama with the newest history that fits the token budget,
+        # plus the parts of the files that match the question (/read and /ask)
+        # The call waits in the LLM queue until it's its turn
+        started = time.perf_counter()
+        estimator = get_estimator(model)
+        messages = session.prompt(estimator, extra=context)
+        ai_reply, first_visible, stats = await llm_queue.submit(lambda: generate_reply(message.chat.id, messages))
 
         # 4. Add TARS's reply to history
-        chat_history.append({'role': 'assistant', 'content': ai_reply})
-
-        # 5. Prevent history from bloating (Keep system prompt + last 12 messages)
-        if len(chat_history) > 15:
-            chat_history = [chat_history[0]] + chat_history[-14:]
+        session.add('assistant', ai_reply)
+        if stats and stats.get('eval_count'):
+            estimator.calibrate(ai_reply, stats['eval_count'])
+        if stats and stats.get('prompt_eval_count'):
+            session.prompt_eval_count = stats['prompt_eval_count']
+            log_prompt_stats(session, stats)
+
+        # 5. Prevent history from bloating, older messages are summarized in the background
+        run_in_background(compact_history(session, estimator))
+        if first_visible is not None:
+            print(f"Reply: first text visible after {first_visible:.2f}s, "
+                  f"complete after {time.perf_counter() - started:.2f}s")
+
+    except asyncio.QueueFull:
+        session.history.pop()
+        outbox.reply(message, "⏳ I'm busy with other messages, please try again in a moment.")
+    except Exception as e:
+        outbox.reply(message, f"⚠️ LLM Error: {str(e)}")
+
+
+def log_prompt_stats(session, stats):
+    # Ollama only evaluates the part of the prompt after the longest prefix it still has cached,
+    # so prompt_eval_count well below the prompt size means the cache was reused
+    evaluated = stats['prompt_eval_count']
+    seconds = (stats.get('prompt_eval_duration') or 0) / 1e9
+    reused = max(0.0, 1 - evaluated / session.prompt_tokens) if session.prompt_tokens else 0.0
+    prompt_stats['turns'] += 1
+    prompt_stats['prompt_tokens'] += session.prompt_tokens
+    prompt_stats['evaluated_tokens'] += evaluated
+    prompt_stats['eval_seconds'] += seconds
+    print(f"Prompt: ~{session.prompt_tokens} of {CONTEXT_TOKEN_BUDGET} tokens, Ollama evaluated {evaluated} "
+          f"in {seconds * 1000:.0f}ms (~{reused:.0%} reused from cache)")
+
+
+def file_context(session, question):
+    # The parts of the file from /read that match the question best
+    if session.document is None:
+        return []
+    chunks = session.document.search(question)
+    return [{'role': 'system',
+             'content': f"Here are the parts of the file {session.document.name} that match the next question:\n\n"
+                        + "\n\n---\n\n".join(chunks)
+                        + "\n\nPlease use this information to answer any specific questions about the file."}]
+
+
+async def generate_reply(chat_id, messages):
+    """
+    Asks Ollama for a reply and sends it to the chat. Returns the reply, the seconds until
+    the first text was visible (None if nothing was sent) and Ollama's token counts.
+    """
+    started = time.perf_counter()
+    if STREAM_REPLIES:
+        return await stream_reply(chat_id, await ollama_client.chat(
+            model=model,
+            messages=messages,
+            stream=True,
+            keep_alive=models.keep_alive(model),
+        ))
+    response = await ollama_client.chat(
+        model=model,
+        messages=messages,
+        keep_alive=models.keep_alive(model),
+    )
+    ai_reply = response['message']['content']
+    await outbox.send(chat_id, ai_reply)
+    return ai_reply, time.perf_counter() - started if ai_reply.strip() else None, response
 
-        send_long_message(message.chat.id, ai_reply)
 
+async def compact_history(session, estimator):
+    # Folds the older messages of a long chat into a running summary, so they still count
+    # for something once they no longer fit in the prompt
+    old = session.take_old_messages(estimator)
+    if old is None:
+        return
+    try:
+        summary = await llm_queue.submit(lambda: summarize_history(session.summary, old))
+        async with session.lock:
+            session.fold(old, summary)
+        print(f"History: folded {len(old)} messages into the summary")
+    except asyncio.QueueFull:
+        # Busy with replies, it is tried again after the next one
+        pass
     except Exception as e:
-        bot.reply_to(message, f"⚠️ LLM Error: {str(e)}")
-
-
-print(f"{bot_name} is online...")
-# Re-schedule missed/future reminders on startup
-for r in load_reminders():
-    due = datetime.strptime(r['due_time'], "%Y-%m-%d %H:%M:%S")
-    if due > datetime.now():
-        scheduler.add_job(send_reminder_callback, 'date', run_date=due, args=[r['chat_id'], r['task'], r.get('id')])
-
-print(f"{bot_name} is ready and reminders are loaded!")
-# bot.infinity_polling()
-bot.infinity_polling(timeout=10, long_polling_timeout=20)
-# timeout is when asking telegram for new messages, it will wait 10 seconds for a response from the server before trying again.
-# long_polling_timeout, without it the bot asks for new messages 100 times a second, however this will have telegram hold our request for x seconds.
-# If something comes in those x seconds it sends immediately, if not it will send an empty response after 5 seconds.
\ No newline at end of file
+        print(f"Error summarizing history: {e}")
+    finally:
+        session.compacting = False
+
+
+async def summarize_history(summary, messages):
+    # Long messages (like files from /read) are cut, the summary only needs the gist
+    conversation = "\n".join(f"{m['role']}: {m['content'][:SUMMARY_MESSAGE_CHARS]}" for m in messages)
+    prompt = (
+        "Update the summary of a conversation between a user and their assistant with the new messages. "
+        "Keep names, dates, decisions and open questions. Answer with the summary only, at most 200 words.\n\n"
+        f"Current summary:\n{summary or '(empty)'}\n\nNew messages:\n{conversation}"
+    )
+    response = await ollama_client.chat(model=model, messages=[{'role': 'user', 'content': prompt}],
+                                        keep_alive=models.keep_alive(model))
+    return response['message']['content'].strip()
+
+
+async def run_bot():
+    print(f"{bot_name} is online...")
+    scheduler.start()
+    run_in_background(warm_model())
+    # Re-schedule future reminders on startup
+    for r in reminder_store.due_after(datetime.now()):
+        due = datetime.strptime(r['due_time'], TIME_FORMAT)
+        scheduler.add_job(send_reminder_callback, 'date', run_date=due, args=[r['chat_id'], r['task'], r['id']],
+                          id=r['id'])
+
+    print(f"{bot_name} is ready and reminders are loaded!")
+    if WEBHOOK_URL:
+        # Telegram posts every update to the local server as soon as it arrives, no polling connection is kept open
+        server = WebhookServer(bot, path=urlparse(WEBHOOK_URL).path or "/")
+        host, port = await server.start()
+        await bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=['message'])
+        print(f"Receiving updates at {WEBHOOK_URL} (listening on {host}:{port})")
+        await asyncio.Event().wait()
+    # Telegram doesn't answer polling while a webhook is set, like one left from an earlier run in webhook mode
+    await bot.delete_webhook()
+    await bot.infinity_polling(timeout=20, request_timeout=30)
+    # timeout (long polling): telegram holds our request for up to 20 seconds and answers as soon as a message comes in,
+    # without it the bot asks for new messages over and over.
+    # request_timeout is how long we wait for telegram to answer before trying again.
+
+
+if __name__ == "__main__":
+    asyncio.run(run_bot())
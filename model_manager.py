@@ -0,0 +1,75 @@
+import os
+import time
+
+# How long the list of installed models is reused before asking Ollama again
+MODEL_LIST_TTL = int(os.getenv("MODEL_LIST_TTL", 300))
+# How long Ollama keeps the chat model in memory after the last message (Ollama's own default is 5m)
+CHAT_KEEP_ALIVE = os.getenv("CHAT_KEEP_ALIVE", "30m")
+# Per-model overrides, like "gemma3:4b=1h,llama3.2:3b=10m" (-1 keeps a model loaded forever)
+MODEL_KEEP_ALIVE = os.getenv("MODEL_KEEP_ALIVE", "")
+
+
+def parse_keep_alive(text):
+    policies = {}
+    for item in text.split(","):
+        if "=" in item:
+            name, value = item.rsplit("=", 1)
+            value = value.strip()
+            policies[name.strip()] = int(value) if value.lstrip("-").isdigit() else value
+    return policies
+
+
+class ModelManager:
+    """
+    Keeps track of the Ollama models for the chat: caches the list of installed models,
+    loads a model before it is needed and unloads the previous one when switching.
+    """
+
+    def __init__(self, client, list_ttl=MODEL_LIST_TTL, keep_alive=CHAT_KEEP_ALIVE, policies=MODEL_KEEP_ALIVE):
+        self.client = client
+        self.list_ttl = list_ttl
+        self.default_keep_alive = keep_alive
+        self.policies = parse_keep_alive(policies)
+        self.models = None
+        self.listed_at = 0.0
+
+    def keep_alive(self, model):
+        return self.policies.get(model, self.default_keep_alive)
+
+    async def installed(self, refresh=False):
+        if refresh or self.models is None or time.monotonic() - self.listed_at > self.list_ttl:
+            models_data = await self.client.list()
+            # In the latest library, 'models' is an attribute, and each model has a '.model' property
+            self.models = [m.model for m in models_data.models]
+            self.listed_at = time.monotonic()
+        return self.models
+
+    async def is_installed(self, model):
+        # A model that was pulled after the list was cached is found with a fresh list
+        return model in await self.installed() or model in await self.installed(refresh=True)
+
+    async def warm(self, model):
+        """
+        Loads the model into memory with an empty request, returns the seconds it took.
+        """
+        started = time.perf_counter()
+        await self.client.generate(model=model, prompt="", keep_alive=self.keep_alive(model))
+        seconds = time.perf_counter() - started
+        print(f"Model {model} loaded in {seconds:.1f}s")
+        return seconds
+
+    async def unload(self, model):
+        await self.client.generate(model=model, prompt="", keep_alive=0)
+        print(f"Model {model} unloaded")
+
+    async def switch(self, old_model, new_model, keep_loaded=()):
+        """
+        Unloads the old model first so the two don't compete for memory, then loads the new one.
+        Models in `keep_loaded` (like the email sorter's) stay in memory.
+        """
+        if old_model and old_model != new_model and old_model not in keep_loaded:
+            try:
+                await self.unload(old_model)
+            except Exception as e:
+                print(f"Error unloading {old_model}: {e}")
+        return await self.warm(new_model)
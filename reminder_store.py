@@ -0,0 +1,116 @@
+import json
+import os
+from bisect import bisect_left, insort
+import sqlite3
+import threading
+
+# SQLite file storing all reminders
+REMINDERS_DB = "reminders.db"
+# due_time is stored as text in this format, which sorts the same way as the times themselves
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class ReminderStore:
+    """
+    Reminders stored in SQLite, indexed on due time and chat ID, with an in-memory copy for reads.
+    Every change is one SQLite transaction followed by the same change in memory, both under a lock,
+    so handlers on different threads can't overwrite each other's reminders.
+    Reminders are dicts with the keys id, chat_id, task and due_time, like the old reminders.json.
+    The in-memory copy also keeps a sorted (due_time, id) list, so time range lookups are a binary search.
+    """
+
+    def __init__(self, path=REMINDERS_DB, legacy_json=None):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS reminders "
+                              "(id TEXT PRIMARY KEY, chat_id INTEGER NOT NULL, task TEXT NOT NULL, "
+                              "due_time TEXT NOT NULL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS reminders_due_time ON reminders (due_time)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS reminders_chat_id ON reminders (chat_id, due_time)")
+            rows = self.conn.execute("SELECT id, chat_id, task, due_time FROM reminders").fetchall()
+        self.cache = {row[0]: self.to_dict(row) for row in rows}
+        self.by_time = sorted((r["due_time"], r["id"]) for r in self.cache.values())
+
+        if legacy_json and os.path.exists(legacy_json):
+            self.migrate(legacy_json)
+
+    @staticmethod
+    def to_dict(row):
+        return {"id": row[0], "chat_id": row[1], "task": row[2], "due_time": row[3]}
+
+    def migrate(self, legacy_json):
+        # One-time import of reminders.json, renamed afterwards so it isn't imported again
+        with open(legacy_json, "r") as f:
+            reminders = json.load(f)
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO reminders VALUES (?, ?, ?, ?)",
+                                  [(r["id"], r["chat_id"], r["task"], r["due_time"]) for r in reminders if r.get("id")])
+            for r in reminders:
+                if r.get("id") and r["id"] not in self.cache:
+                    self.cache[r["id"]] = {k: r[k] for k in ("id", "chat_id", "task", "due_time")}
+                    insort(self.by_time, (r["due_time"], r["id"]))
+        os.replace(legacy_json, legacy_json + ".migrated")
+
+    def all(self):
+        """
+        Every reminder, soonest first.
+        """
+        with self.lock:
+            return sorted(self.cache.values(), key=lambda r: r["due_time"])
+
+    def add(self, reminder_id, chat_id, task, due_time):
+        reminder = {"id": reminder_id, "chat_id": chat_id, "task": task, "due_time": due_time.strftime(TIME_FORMAT)}
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO reminders VALUES (?, ?, ?, ?)",
+                              (reminder_id, chat_id, task, reminder["due_time"]))
+            self.cache[reminder_id] = reminder
+            insort(self.by_time, (reminder["due_time"], reminder_id))
+        return reminder
+
+    def remove(self, reminder_id):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM reminders WHERE id = ?", (reminder_id,))
+            reminder = self.cache.pop(reminder_id, None)
+            if reminder is not None:
+                i = bisect_left(self.by_time, (reminder["due_time"], reminder_id))
+                del self.by_time[i]
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM reminders")
+            self.cache.clear()
+            self.by_time.clear()
+
+    def window(self, start, end, limit):
+        """
+        Returns up to `limit` reminders due between start and end (soonest first),
+        and how many stored reminders were left out.
+        """
+        with self.lock:
+            i = bisect_left(self.by_time, (start.strftime(TIME_FORMAT),))
+            j = bisect_left(self.by_time, (end.strftime(TIME_FORMAT),))
+            shown = [self.cache[reminder_id] for _, reminder_id in self.by_time[i:min(j, i + limit)]]
+            return shown, len(self.by_time) - len(shown)
+
+    def count(self, start, end):
+        """
+        How many reminders are due between start and end.
+        """
+        with self.lock:
+            return (bisect_left(self.by_time, (end.strftime(TIME_FORMAT),))
+                    - bisect_left(self.by_time, (start.strftime(TIME_FORMAT),)))
+
+    def due_after(self, moment):
+        """
+        Reminders due after `moment`, soonest first. Uses the due_time index.
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT id, chat_id, task, due_time FROM reminders WHERE due_time > ? "
+                                     "ORDER BY due_time", (moment.strftime(TIME_FORMAT),)).fetchall()
+        return [self.to_dict(row) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,131 @@
+import asyncio
+import getpass
+import os
+import tempfile
+
+# Control socket of the shared connection, a file in the temp folder when it isn't set
+SSH_CONTROL_PATH = os.getenv("SSH_CONTROL_PATH")
+# OpenSSH on Windows can't share a connection (no ControlMaster), there every command connects on its own
+SSH_MULTIPLEX = os.name != 'nt'
+# Seconds to wait for the connection to the server to come up
+SSH_CONNECT_TIMEOUT = int(os.getenv("SSH_CONNECT_TIMEOUT", 15))
+# ssh exits with this code when the connection failed, the remote command's own codes are passed through
+SSH_ERROR = 255
+
+
+def default_control_path():
+    try:
+        user = getpass.getuser()
+    except Exception:
+        # No user name in the environment or the password database
+        user = "default"
+    return os.path.join(tempfile.gettempdir(), f"tars-ssh-{user}")
+
+
+class SSHChannel:
+    """
+    Keeps one SSH connection open to `target` and runs commands over it as extra sessions
+    (OpenSSH connection multiplexing), so only the first command pays for the TCP connection and key exchange.
+    The connection is opened on first use, checked before every command and opened again if it dropped.
+    Without multiplexing (Windows) every command is a plain ssh call.
+    """
+
+    def __init__(self, target, control_path=SSH_CONTROL_PATH, connect_timeout=SSH_CONNECT_TIMEOUT,
+                 multiplex=SSH_MULTIPLEX):
+        self.target = target
+        self.control_path = control_path or default_control_path()
+        self.multiplex = multiplex
+        self.connect_timeout = connect_timeout
+        self.master = None
+        self.lock = asyncio.Lock()
+        self.stats = {'connects': 0, 'commands': 0, 'reconnects': 0}
+
+    def options(self):
+        options = ["-o", "BatchMode=yes", "-o", f"ConnectTimeout={self.connect_timeout}"]
+        if self.multiplex:
+            options += ["-o", f"ControlPath={self.control_path}"]
+        return options
+
+    async def ssh(self, *args, timeout):
+        """
+        Runs ssh with the channel's options, returns (returncode, stdout, stderr).
+        """
+        process = await asyncio.create_subprocess_exec(
+            "ssh", *self.options(), *args,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise
+        return process.returncode, stdout.decode(), stderr.decode()
+
+    async def alive(self):
+        if self.master is None or self.master.returncode is not None:
+            return False
+        returncode, _, _ = await self.ssh("-O", "check", self.target, timeout=self.connect_timeout)
+        return returncode == 0
+
+    async def connect(self):
+        async with self.lock:
+            if await self.alive():
+                return
+            await self.close_master()
+            # A connection that was killed leaves its socket behind, and ssh won't start a new one on top of it
+            if "%" not in self.control_path and os.path.exists(self.control_path):
+                os.remove(self.control_path)
+            # -N: no remote command, this process only holds the connection.
+            # ServerAlive makes it exit when the server stops answering, so a dead connection is noticed.
+            self.master = await asyncio.create_subprocess_exec(
+                "ssh", *self.options(), "-o", "ControlMaster=yes", "-o", "ControlPersist=no",
+                "-o", "ServerAliveInterval=30", "-o", "ServerAliveCountMax=3", "-o", "LogLevel=ERROR",
+                "-N", self.target,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            self.stats['connects'] += 1
+            deadline = asyncio.get_running_loop().time() + self.connect_timeout
+            while not await self.alive():
+                if self.master.returncode is not None:
+                    error = (await self.master.stderr.read()).decode().strip()
+                    self.master = None
+                    raise ConnectionError(error or f"ssh exited with code {SSH_ERROR}")
+                if asyncio.get_running_loop().time() > deadline:
+                    await self.close_master()
+                    raise asyncio.TimeoutError()
+                await asyncio.sleep(0.05)
+
+    async def run(self, command, timeout=SSH_CONNECT_TIMEOUT):
+        """
+        Runs a command on the server over the shared connection, returns (returncode, stdout, stderr).
+        """
+        if not self.multiplex:
+            self.stats['commands'] += 1
+            return await self.ssh(self.target, command, timeout=timeout)
+        if self.master is None or self.master.returncode is not None:
+            await self.connect()
+        result = await self.ssh(self.target, command, timeout=timeout)
+        if result[0] == SSH_ERROR and not await self.alive():
+            # The connection dropped since the last command, connect again and retry once
+            self.stats['reconnects'] += 1
+            await self.connect()
+            result = await self.ssh(self.target, command, timeout=timeout)
+        self.stats['commands'] += 1
+        return result
+
+    async def close_master(self):
+        if self.master is None:
+            return
+        if self.master.returncode is None:
+            self.master.terminate()
+            await self.master.wait()
+        self.master = None
+
+    async def close(self):
+        async with self.lock:
+            await self.close_master()
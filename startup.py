@@ -2,8 +2,8 @@ import os
 import time
 import sys
 import telebot
-import json
 from dotenv import load_dotenv
+from reminder_store import ReminderStore, REMINDERS_DB
 
 # --- Terminal Styling ---
 BLUE = "\033[38;5;33m"
@@ -75,14 +75,13 @@ def main():
     os.system('cls' if os.name == 'nt' else 'clear')
     print(ART)
 
-    # Check of .json file exists
-    if not os.path.exists("reminders.json"):
+    # Check if the reminders database exists
+    if not os.path.exists(REMINDERS_DB):
         try:
-            with open("reminders.json", "w") as j:
-                json.dump([], j)
-            loading_bar(0.5, "INITIALIZING JSON DB")
+            ReminderStore().close()
+            loading_bar(0.5, "INITIALIZING REMINDER DB")
         except Exception as e:
-            print(f"{RED}Error creating reminders.json: {e}{RESET}")
+            print(f"{RED}Error creating {REMINDERS_DB}: {e}{RESET}")
 
     #Check if env file exists
     if os.path.exists(".env"):
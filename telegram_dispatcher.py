@@ -0,0 +1,292 @@
+import asyncio
+import os
+import re
+import time
+from collections import deque
+
+from telebot import types
+from telebot.asyncio_helper import ApiTelegramException, RequestTimeout
+
+# Telegram allows 4096 characters per message (counted in UTF-16 code units), messages are split a bit below that
+MESSAGE_LIMIT = 4000
+# Telegram asks bots to send about one message per second to a chat, with short bursts allowed,
+# and at most about 30 messages per second in total
+CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1.0))
+CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", 3))
+GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 25.0))
+# Give up on a message after this many 429 (Too Many Requests) answers or dropped connections
+MAX_ATTEMPTS = 5
+# Seconds before sending again after a dropped connection, doubled every time
+RETRY_DELAY = 0.5
+
+HTML_TAG = re.compile(r"<(/?)([a-zA-Z-]+)[^>]*>")
+# Markdown markers that have to be closed in the chunk they were opened in, longest first
+MARKDOWN_MARKERS = ("```", "`", "*", "_")
+
+
+def utf16_len(text):
+    return len(text.encode("utf-16-le")) // 2
+
+
+def cut_point(text, limit):
+    """
+    Where to cut text so the first part has at most `limit` UTF-16 code units,
+    preferring a line break, then a space. Never cuts inside a character.
+    """
+    units = 0
+    end = len(text)
+    for i, char in enumerate(text):
+        units += 2 if ord(char) > 0xFFFF else 1
+        if units > limit:
+            end = i
+            break
+    else:
+        return end
+    for separator in ("\n", " "):
+        i = text.rfind(separator, 0, end)
+        if i > end // 2:
+            return i + 1
+    return end
+
+
+def split_html(text, limit):
+    chunks = []
+    reopen = ""
+    while text:
+        text = reopen + text
+        # Room for the closing tags added at the end
+        end = cut_point(text, limit - 100) if utf16_len(text) > limit else len(text)
+        chunk = text[:end]
+        # Don't cut inside a tag or an entity like &amp;
+        if chunk.rfind("<") > chunk.rfind(">"):
+            chunk = chunk[:chunk.rfind("<")]
+        if chunk.rfind("&") > chunk.rfind(";"):
+            chunk = chunk[:chunk.rfind("&")]
+        if not chunk.strip():
+            chunk = text[:end]
+        text = text[len(chunk):]
+        # Close the tags that are still open and open them again in the next chunk
+        open_tags = []
+        for match in HTML_TAG.finditer(chunk):
+            if match.group(1):
+                if open_tags and open_tags[-1][0] == match.group(2).lower():
+                    open_tags.pop()
+            else:
+                open_tags.append((match.group(2).lower(), match.group(0)))
+        chunk += "".join(f"</{name}>" for name, _ in reversed(open_tags))
+        reopen = "".join(tag for _, tag in open_tags) if text else ""
+        chunks.append(chunk)
+    return chunks
+
+
+def split_markdown(text, limit):
+    chunks = []
+    reopen = ""
+    while text:
+        text = reopen + text
+        end = cut_point(text, limit - 10) if utf16_len(text) > limit else len(text)
+        chunk, text = text[:end], text[end:]
+        # A marker that appears an odd number of times is still open at the cut
+        unclosed = []
+        rest = chunk
+        for marker in MARKDOWN_MARKERS:
+            if rest.count(marker) % 2:
+                unclosed.append(marker)
+            rest = rest.replace(marker, "")
+        chunk += "".join(reversed(unclosed))
+        reopen = "".join(unclosed) if text else ""
+        chunks.append(chunk)
+    return chunks
+
+
+def split_message(text, parse_mode=None, limit=MESSAGE_LIMIT):
+    """
+    Splits text into messages Telegram accepts. HTML tags and Markdown markers that are open
+    at a cut are closed at the end of one part and opened again at the start of the next.
+    """
+    if utf16_len(text) <= limit:
+        return [text]
+    if parse_mode == "HTML":
+        return split_html(text, limit)
+    if parse_mode and parse_mode.startswith("Markdown"):
+        return split_markdown(text, limit)
+    chunks = []
+    while text:
+        end = cut_point(text, limit)
+        chunks.append(text[:end])
+        text = text[end:]
+    return chunks
+
+
+class TokenBucket:
+    """
+    Allows `rate` messages per second on average and bursts of up to `capacity`.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def take(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Outgoing:
+    def __init__(self, kind, chat_id, text, parse_mode=None, reply_to=None, message_id=None, coalesce=True):
+        self.kind = kind  # 'send' or 'edit'
+        self.chat_id = chat_id
+        self.text = text
+        self.parse_mode = parse_mode
+        self.reply_to = reply_to
+        self.message_id = message_id
+        self.coalesce = coalesce
+        self.futures = []
+
+    def absorb(self, other):
+        """
+        Merges `other` (queued right after this one) into this message if that is allowed.
+        """
+        if self.kind == 'edit' and other.kind == 'edit' and other.message_id == self.message_id:
+            # Only the newest text of an edited message matters
+            self.text, self.parse_mode = other.text, other.parse_mode
+        elif (self.kind == 'send' and other.kind == 'send' and self.coalesce and other.coalesce
+              and other.reply_to is None and other.parse_mode == self.parse_mode
+              and utf16_len(self.text) + utf16_len(other.text) + 2 <= MESSAGE_LIMIT):
+            self.text += "\n\n" + other.text
+        else:
+            return False
+        self.futures.extend(other.futures)
+        return True
+
+
+class OutboundDispatcher:
+    """
+    Every message the bot sends goes through here. send(), reply() and edit() queue the message and
+    return a future right away, so handlers and reminder callbacks don't wait for Telegram. Each chat
+    has its own queue and token bucket, Telegram's retry_after is respected, and small messages that
+    pile up in a queue are sent as one.
+    """
+
+    def __init__(self, bot, chat_rate=CHAT_RATE, chat_burst=CHAT_BURST, global_rate=GLOBAL_RATE):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.buckets = {}
+        self.queues = {}
+        self.workers = {}
+        self.stats = {'sent': 0, 'edited': 0, 'coalesced': 0, 'retries': 0, 'failed': 0}
+
+    def send(self, chat_id, text, parse_mode=None, reply_to=None, coalesce=True):
+        """
+        Queues a message, split into parts if it is too long. The future resolves to the last part sent.
+        """
+        parts = split_message(text, parse_mode)
+        future = None
+        for i, part in enumerate(parts):
+            future = self.queue(Outgoing('send', chat_id, part, parse_mode, reply_to if i == 0 else None,
+                                         coalesce=coalesce))
+        return future
+
+    def reply(self, message, text, parse_mode=None):
+        return self.send(message.chat.id, text, parse_mode, reply_to=message.message_id)
+
+    def edit(self, chat_id, message_id, text, parse_mode=None):
+        return self.queue(Outgoing('edit', chat_id, text, parse_mode, message_id=message_id))
+
+    def queue(self, item):
+        future = asyncio.get_running_loop().create_future()
+        # Nobody has to wait for a message, so failures that nobody looks at are not reported again
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        item.futures.append(future)
+        self.queues.setdefault(item.chat_id, deque()).append(item)
+        if item.chat_id not in self.workers:
+            self.workers[item.chat_id] = asyncio.create_task(self.worker(item.chat_id))
+        return future
+
+    async def worker(self, chat_id):
+        queue = self.queues[chat_id]
+        if chat_id not in self.buckets:
+            self.buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        try:
+            while queue:
+                await self.buckets[chat_id].take()
+                await self.global_bucket.take()
+                # Merge whatever piled up while waiting for the bucket
+                item = queue.popleft()
+                while queue and item.absorb(queue[0]):
+                    queue.popleft()
+                    self.stats['coalesced'] += 1
+                await self.deliver(item)
+        finally:
+            del self.workers[chat_id]
+
+    async def call(self, item):
+        if item.kind == 'edit':
+            return await self.bot.edit_message_text(item.text, item.chat_id, item.message_id,
+                                                    parse_mode=item.parse_mode)
+        reply_parameters = None
+        if item.reply_to is not None:
+            reply_parameters = types.ReplyParameters(item.reply_to, allow_sending_without_reply=True)
+        return await self.bot.send_message(item.chat_id, item.text, parse_mode=item.parse_mode,
+                                           reply_parameters=reply_parameters)
+
+    async def deliver(self, item):
+        result = None
+        error = None
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                result = await self.call(item)
+                error = None
+                break
+            except ApiTelegramException as e:
+                error = e
+                if e.error_code == 429:
+                    # Too many requests, Telegram says how long to wait
+                    self.stats['retries'] += 1
+                    await asyncio.sleep((e.result_json.get('parameters') or {}).get('retry_after', 1))
+                elif e.error_code == 400 and 'parse entities' in e.description and item.parse_mode:
+                    # Broken formatting (like a stray * in an LLM reply), send it as plain text instead
+                    item.parse_mode = None
+                elif e.error_code == 400 and 'message is not modified' in e.description:
+                    error = None
+                    break
+                else:
+                    break
+            except RequestTimeout as e:
+                # telebot raises this when the connection dropped or Telegram didn't answer in time
+                error = e
+                self.stats['retries'] += 1
+                await asyncio.sleep(RETRY_DELAY * 2 ** attempt)
+            except Exception as e:
+                error = e
+                break
+
+        if error is not None:
+            self.stats['failed'] += 1
+            print(f"Error sending to Telegram: {error}")
+        else:
+            self.stats['edited' if item.kind == 'edit' else 'sent'] += 1
+        for future in item.futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    async def drain(self):
+        """
+        Waits until every queued message is sent.
+        """
+        while self.workers:
+            await asyncio.gather(*list(self.workers.values()), return_exceptions=True)
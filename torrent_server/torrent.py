@@ -1,4 +1,6 @@
-import subprocess
+import fcntl
+import json
+import socket
 import time
 import qbittorrentapi
 import sys
@@ -13,105 +15,267 @@ load_dotenv()
 # --- SETTINGS ---
 QBT_USER = os.getenv("QBT_USER")
 QBT_PASS = os.getenv("QBT_PASS")
+# The monitor listens here for new magnet links, later runs of this script hand their links to it
+TORRENT_SOCKET = os.getenv("TORRENT_SOCKET", "/tmp/tars-torrent.sock")
+# Shortest and longest wait between two checks on the downloads, in seconds
+MIN_POLL = 2
+MAX_POLL = 60
+# qBittorrent's eta when it can't tell (no peers)
+NO_ETA = 8640000
 
-def main():
 
-    #function to send updates
-    def send_telegram_update(text):
-        token = os.getenv("TELEGRAM_TOKEN")
-        chat_id = int(os.getenv("ALLOWED_USER_ID"))
-        url = f"https://api.telegram.org/bot{token}/sendMessage?chat_id={chat_id}&text={text}"
-        requests.get(url)
+#function to send updates
+def send_telegram_update(text):
+    token = os.getenv("TELEGRAM_TOKEN")
+    chat_id = int(os.getenv("ALLOWED_USER_ID"))
+    url = f"https://api.telegram.org/bot{token}/sendMessage?chat_id={chat_id}&text={text}"
+    try:
+        requests.get(url, timeout=10)
+    except requests.RequestException as e:
+        # The monitor keeps running, the next update might get through
+        print(f"⚠️  Couldn't send update: {e}")
 
 
-    # Check if a magnet link was provided.
-    # comment out the below to manually add magnet above
-    if len(sys.argv) < 2:
-        error = f"❌ Error: No magnet link provided!"
-        print(error)
-        send_telegram_update(error)
-        print('Usage: python3 smart_download.py "MAGNET_LINK_HERE"')
-        return
-    # Get the link from the command line argument
-    MAGNET_LINK = sys.argv[1]
-    # Extract unique hash from magnet link
-    info_hash = re.search(r'btih:([a-zA-Z0-9]+)', MAGNET_LINK).group(1).lower()
+def info_hash(link):
+    # Extract unique hash from the magnet link
+    match = re.search(r'btih:([a-zA-Z0-9]+)', link)
+    return match.group(1).lower() if match else None
 
-    try:
-        # 1. Connect to qBittorrent
-        qbt = qbittorrentapi.Client(host='localhost', port=8080, username=QBT_USER, password=QBT_PASS)
+
+def hand_off(links):
+    """
+    Gives the links to the running monitor, returns False if there is none.
+    """
+    with socket.socket(socket.AF_UNIX) as s:
+        s.settimeout(10)
         try:
-            qbt.auth_log_in()
-        except qbittorrentapi.LoginFailed:
-            print("❌ QBT Login Failed! Check your password.")
-            return
+            s.connect(TORRENT_SOCKET)
+            s.sendall(json.dumps({"magnets": links}).encode() + b"\n")
+            return s.makefile().readline().strip() == "ok"
+        except (FileNotFoundError, ConnectionRefusedError, socket.timeout):
+            return False
 
+
+class TorrentMonitor:
+    """
+    Watches every torrent sent with /torrent from one process. New links come in over a unix socket,
+    and qBittorrent is asked only for what changed since the last check (sync/maindata with a response id),
+    so a check costs about the same with one download or fifty. The wait between checks follows
+    the closest download to its next update.
+    """
+
+    def __init__(self, qbt):
+        self.qbt = qbt
+        self.rid = 0
+        # Everything qBittorrent reported so far, by hash, kept up to date with the changes
+        self.torrents = {}
+        # The downloads we report on, by hash, with the updates already sent for each
+        self.tracked = {}
+        self.next_check = time.monotonic()
+        self.failing = False
+
+    def add(self, links):
         # 3. Add Torrent with "No Seeding" settings
-        update = f"🚀 Adding torrent to queue..."
+        update = f"🚀 Adding {len(links)} torrent(s) to queue..."
         print(update)
         send_telegram_update(update)
         # *********************************************
         # ADJUST ratio_limit and seeding_time_limit to stop seeding
-        qbt.torrents_add(
-            urls=MAGNET_LINK,
-            paused=False,
-            ratio_limit=1.5, #1.5 will seed 1.5 times as much as you downloaded. Set to 0 to not seed.
-            seeding_time_limit=-1 #Set to 0 to not seed. -1 will ignore time limit and keep seeding until ratio is hit.
-        )
-
-        # 4. Monitor Progress
-        #update = f"📊 Downloading (Monitoring status)..."
-        half_way = False
-        beginning = False
+        try:
+            self.qbt.torrents_add(
+                urls=links,
+                paused=False,
+                ratio_limit=1.5, #1.5 will seed 1.5 times as much as you downloaded. Set to 0 to not seed.
+                seeding_time_limit=-1 #Set to 0 to not seed. -1 will ignore time limit and keep seeding until ratio is hit.
+            )
+        except Exception as e:
+            # Like qBittorrent restarting, the downloads already tracked keep being watched
+            print(f"\n⚠️  Couldn't add the torrent(s): {e}")
+            send_telegram_update(f"⚠️  Couldn't add the torrent(s): {e}")
+            return
+        # Check on them soon, qBT needs a moment to register new links
+        soon = time.monotonic() + MIN_POLL
+        self.next_check = min(self.next_check, soon) if self.tracked else soon
+        for link in links:
+            info = info_hash(link)
+            if info:
+                self.tracked.setdefault(info, set())
 
-        while True:
-            # Look for ONLY the specific torrent we just added
-            torrents = qbt.torrents_info(torrent_hashes=info_hash)
+    def receive(self, conn):
+        with conn:
+            conn.settimeout(5)
+            try:
+                request = json.loads(conn.makefile().readline())
+                links = [link for link in request["magnets"] if link.startswith("magnet:")]
+                conn.sendall(b"ok\n")
+            except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+                print(f"⚠️  Bad request: {e}")
+                return
+        if links:
+            self.add(links)
 
-            if not torrents:
-                time.sleep(2)  # Wait for qBT to register the new link
-                continue
+    def sync(self):
+        data = self.qbt.sync_maindata(rid=self.rid)
+        self.rid = data.get("rid", 0)
+        if data.get("full_update"):
+            self.torrents = {}
+        # Only the fields that changed are sent, merge them into what we have
+        for info, changes in data.get("torrents", {}).items():
+            self.torrents.setdefault(info, {}).update(changes)
+        for info in data.get("torrents_removed", []):
+            self.torrents.pop(info, None)
+            if self.tracked.pop(info, None) is not None:
+                print(f"\n🗑️ {info} was removed from qBittorrent.")
 
-            t = torrents[0]
+    def report(self, info, t, sent):
+        """
+        Sends the updates a download has reached, returns True once it is complete.
+        """
+        name = t.get("name", info)
+        progress = t.get("progress", 0) * 100
+        speed = t.get("dlspeed", 0) / 1024 / 1024  # Convert to MB/s
 
-            progress = t.progress * 100
-            speed = t.dlspeed / 1024 / 1024  # Convert to MB/s
+        progress_pct = int(progress)  # Get whole number like 25, 26.
+        # Until the metadata arrives the torrent is named after its hash
+        if "beginning" not in sent and name != info:
+            sent.add("beginning")
+            send_telegram_update(f"📥 Started downloading: {name}")
 
-            #sys.stdout.write(f"\rProgress: {progress:.2f}% | Speed: {speed:.2f} MB/s | Status: {t.state}    ")
-            #sys.stdout.flush()
+        if (progress_pct >= 50) and ("half_way" not in sent):
+            sent.add("half_way")
+            update_text = f"⏳ Downloading: {name} \n📊Progress: {progress_pct}% | Speed: {speed:.2f} MB/s"
+            send_telegram_update(update_text)
 
-            progress_pct = int(progress)  # Get whole number like 25, 26.
-            if not beginning and t.name != info_hash:
-                beginning = True
-                filename = t.name
-                send_telegram_update(f"📥 Started downloading: {filename}")
+        # 5. Handle Completion (Stop seeding immediately)
+        # 'uploading' or 'seeding' means the download is 100% done
+        if t.get("progress") == 1.0 or t.get("state") in ['uploading', 'seeding', 'stalledUP']:
+            print(f"\n✅ Download 100% complete.")
+            update = f"✅ {name} download 100% complete."
+            send_telegram_update(update)
 
-            if (progress_pct >= 50) and (not half_way):
-                half_way =True
-                filename = t.name
-                update_text = f"⏳ Downloading: {filename} \n📊Progress: {progress_pct}% | Speed: {speed:.2f} MB/s"
-                send_telegram_update(update_text)
+            # Optional: Delete the torrent from the list but KEEP the file
+            #*************************************
+            #UNCOMMENT THE BELOW LINES TO STOP SEEDING AND REMOVE ENTRY.
+            # update = f"🧹 Cleaning up qBittorrent (Removing torrent entry)..."
+            # print(update)
+            # send_telegram_update(update)
+            #self.qbt.torrents_delete(delete_files=False, torrent_hashes=info)
+            return True
+        return False
 
-            # 5. Handle Completion (Stop seeding immediately)
-            # 'uploading' or 'seeding' means the download is 100% done
-            if t.progress == 1.0 or t.state in ['uploading', 'seeding', 'stalledUP']:
-                print(f"\n✅ Download 100% complete.")
-                filename = t.name
-                update = f"✅ {filename} download 100% complete."
-                send_telegram_update(update)
+    def wait_time(self):
+        """
+        Seconds until the next check: half the time the closest download needs to reach its next update.
+        """
+        waits = []
+        for info, sent in self.tracked.items():
+            t = self.torrents.get(info)
+            if t is None or t.get("name", info) == info:
+                # Not registered yet or still waiting for metadata
+                waits.append(MIN_POLL)
+                continue
+            speed = t.get("dlspeed", 0)
+            if "half_way" not in sent and speed > 0:
+                waits.append((0.5 - t.get("progress", 0)) * t.get("size", 0) / speed)
+            else:
+                waits.append(t.get("eta", NO_ETA))
+        return min(max(min(waits, default=MAX_POLL) / 2, MIN_POLL), MAX_POLL)
 
+    def check(self):
+        try:
+            self.sync()
+        except Exception as e:
+            # Ask for everything again next time, and only tell the user once until it works again
+            self.rid = 0
+            print(f"\n⚠️  An error occurred: {e}")
+            if not self.failing:
+                send_telegram_update(f"⚠️  An error occurred: {e}")
+            self.failing = True
+            self.next_check = time.monotonic() + MAX_POLL
+            return
+        self.failing = False
+        for info, sent in list(self.tracked.items()):
+            t = self.torrents.get(info)
+            if t is not None and self.report(info, t, sent):
+                del self.tracked[info]
+        self.next_check = time.monotonic() + self.wait_time()
+
+    def serve(self, server):
+        while True:
+            if self.tracked and time.monotonic() >= self.next_check:
+                self.check()
+            # With nothing to watch, just wait for new links
+            timeout = self.next_check - time.monotonic() if self.tracked else None
+            if timeout is not None and timeout <= 0:
+                continue
+            server.settimeout(timeout)
+            try:
+                conn, _ = server.accept()
+            except (socket.timeout, BlockingIOError):
+                continue
+            try:
+                self.receive(conn)
+            except Exception as e:
+                # One bad request doesn't stop the monitor
+                print(f"\n⚠️  An error occurred: {e}")
+
+
+def connect_qbt():
+    # 1. Connect to qBittorrent
+    qbt = qbittorrentapi.Client(host='localhost', port=8080, username=QBT_USER, password=QBT_PASS)
+    try:
+        qbt.auth_log_in()
+    except qbittorrentapi.LoginFailed:
+        print("❌ QBT Login Failed! Check your password.")
+        return None
+    return qbt
 
-                # Optional: Delete the torrent from the list but KEEP the file
-                #*************************************
-                #UNCOMMENT THE BELOW LINES TO STOP SEEDING AND REMOVE ENTRY.
-                # update = f"🧹 Cleaning up qBittorrent (Removing torrent entry)..."
-                # print(update)
-                # send_telegram_update(update)
-                #qbt.torrents_delete(delete_files=False, torrent_hashes=t.hash)
 
-                break
+def main():
+    # 'torrent.py --daemon' starts the monitor on its own, otherwise the arguments are magnet links
+    daemon = sys.argv[1:2] == ["--daemon"]
+    # Get the links from the command line arguments, /torrent can send several at once
+    MAGNET_LINKS = [] if daemon else sys.argv[1:]
 
-            time.sleep(5)
+    # Check if a magnet link was provided.
+    if not daemon and not MAGNET_LINKS:
+        error = f"❌ Error: No magnet link provided!"
+        print(error)
+        send_telegram_update(error)
+        print('Usage: python3 torrent.py "MAGNET_LINK_HERE" ["MAGNET_LINK_HERE" ...] | --daemon')
+        return
+
+    # Only one monitor runs, whoever holds the lock is it
+    lock = open(TORRENT_SOCKET + ".lock", "w")
+    while True:
+        if MAGNET_LINKS and hand_off(MAGNET_LINKS):
+            print("📨 Links handed to the running monitor.")
+            return
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            if not MAGNET_LINKS:
+                print("Monitor is already running.")
+                return
+            # Another run is starting the monitor right now, give it a moment
+            time.sleep(0.5)
+
+    try:
+        qbt = connect_qbt()
+        if qbt is None:
+            return
+        # A monitor that was killed leaves its socket behind
+        if os.path.exists(TORRENT_SOCKET):
+            os.remove(TORRENT_SOCKET)
+        with socket.socket(socket.AF_UNIX) as server:
+            server.bind(TORRENT_SOCKET)
+            os.chmod(TORRENT_SOCKET, 0o600)
+            server.listen()
+            monitor = TorrentMonitor(qbt)
+            if MAGNET_LINKS:
+                monitor.add(MAGNET_LINKS)
+            monitor.serve(server)
 
     except KeyboardInterrupt:
         print("\n🛑 Script stopped by user.")
@@ -122,4 +286,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
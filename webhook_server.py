@@ -0,0 +1,87 @@
+import asyncio
+import hmac
+import os
+import secrets
+
+from aiohttp import web
+from telebot import types
+
+# Public HTTPS address Telegram sends updates to, like https://example.com/telegram.
+# Without it the bot uses long polling.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+# Where the local server listens, put it behind a reverse proxy that terminates HTTPS
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+# Telegram sends this back in a header with every update, so nobody else can post fake updates.
+# A new one is made at every start if it isn't set.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+# How many updates are handled at the same time, and how many more can wait before Telegram is asked to resend
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 4))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 100))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """
+    Receives Telegram updates over HTTP. Every POST is checked against the secret token, queued and
+    answered right away, and a pool of workers hands the queued updates to the bot's handlers.
+    When the queue is full the POST gets a 503 and Telegram sends the update again later.
+    """
+
+    def __init__(self, bot, secret=WEBHOOK_SECRET, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE, path="/"):
+        self.bot = bot
+        self.secret = secret
+        self.workers = workers
+        self.path = path
+        self.queue = asyncio.Queue(queue_size)
+        self.tasks = []
+        self.runner = None
+        self.stats = {'received': 0, 'handled': 0, 'rejected': 0, 'busy': 0}
+
+    async def receive(self, request):
+        token = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            self.stats['rejected'] += 1
+            return web.Response(status=401)
+        try:
+            update = types.Update.de_json(await request.text())
+        except (ValueError, KeyError):
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.stats['busy'] += 1
+            return web.Response(status=503)
+        self.stats['received'] += 1
+        return web.Response()
+
+    async def worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.bot.process_new_updates([update])
+                self.stats['handled'] += 1
+            except Exception as e:
+                print(f"Error handling update {update.update_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def start(self, host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+        """
+        Starts the workers and the HTTP server, returns the (host, port) it listens on.
+        """
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+        app = web.Application()
+        app.router.add_post(self.path, self.receive)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        return self.runner.addresses[0][:2]
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+        for task in self.tasks:
+            task.cancel()